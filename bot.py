@@ -1,13 +1,36 @@
 import os
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
 from io import BytesIO
 import signal
+import socket
 import sys
+import glob
+import queue
+import json
+import time
+import threading
+import contextlib
+import hashlib
+import functools
+import cProfile
+import pstats
+import tracemalloc
+import bisect
+import heapq
+import sqlite3
+import multiprocessing
+import weakref
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
 import telebot
-from telebot import types
+from telebot import types, apihelper
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from PIL import Image, ImageDraw, ImageFont
@@ -20,10 +43,17 @@ from reportlab.lib.utils import ImageReader
 from dotenv import load_dotenv
 import yadisk
 
-# Настройка корректного завершения
+# Настройка корректного завершения: прекращаем приём обновлений,
+# дорабатываем начатое и сохраняем состояние (см. save_snapshot)
+shutdown_event = threading.Event()
+
 def signal_handler(sig, frame):
-    logger.info("Bot shutdown gracefully")
-    sys.exit(0)
+    if shutdown_event.is_set() or 'bot' not in globals():
+        logger.info("Bot shutdown")
+        sys.exit(0)
+    logger.info("Shutdown requested, draining...")
+    shutdown_event.set()
+    bot.stop_polling()
 
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
@@ -45,6 +75,112 @@ MASTER_PHONE = os.getenv('MASTER_PHONE')
 YANDEX_DISK_TOKEN = os.getenv('YANDEX_DISK_TOKEN')
 YANDEX_DISK_FOLDER = os.getenv('YANDEX_DISK_FOLDER')
 
+# Общие настройки HTTP-соединений для Telegram, Google Sheets и Яндекс.Диска
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '3'))
+
+class HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter с keep-alive пулом, таймаутами по умолчанию и статистикой по хостам.
+
+    Повторяются только ошибки соединения (запрос ещё не ушёл) и ответы
+    502/503/504 на идемпотентные запросы, поэтому повтор не может
+    продублировать отправку сообщения или запись в таблицу.
+    """
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, status_retries=HTTP_RETRIES,
+                 timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)):
+        retry = Retry(
+            total=HTTP_RETRIES, connect=HTTP_RETRIES, read=0, status=status_retries,
+            status_forcelist=(502, 503, 504), backoff_factor=0.3, raise_on_status=False
+        )
+        super().__init__(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.timeout = timeout
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def send(self, request, timeout=None, **kwargs):
+        host = urlsplit(request.url).hostname
+        started = time.perf_counter()
+        failed = False
+        try:
+            response = super().send(request, timeout=timeout or self.timeout, **kwargs)
+            failed = response.status_code >= 500
+            return response
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.stats_lock:
+                stats = self.stats.setdefault(host, HostStats())
+                stats.requests += 1
+                stats.errors += failed
+                stats.total_time += elapsed
+                stats.max_time = max(stats.max_time, elapsed)
+
+    def connections(self):
+        """Число открытых за всё время соединений по хостам (из пулов urllib3)"""
+        opened = {}
+        for key in list(self.poolmanager.pools.keys()):
+            pool = self.poolmanager.pools.get(key)
+            if pool is not None:
+                opened[pool.host] = opened.get(pool.host, 0) + pool.num_connections
+        return opened
+
+http_adapters = weakref.WeakSet()
+
+def pooled_session(session=None, pool_size=HTTP_POOL_SIZE, status_retries=HTTP_RETRIES):
+    """Подключает к сессии (или новой сессии) общий тип адаптера с пулом соединений"""
+    session = session or requests.Session()
+    adapter = PooledAdapter(pool_size, status_retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    http_adapters.add(adapter)
+    return session
+
+def http_stats_text():
+    """Сводка по исходящим запросам: запросы, ошибки, задержки и новые соединения по хостам"""
+    totals = {}
+    for adapter in list(http_adapters):
+        connections = adapter.connections()
+        with adapter.stats_lock:
+            items = list(adapter.stats.items())
+        for host, stats in items:
+            total = totals.setdefault(host, [0, 0, 0.0, 0.0, 0])
+            total[0] += stats.requests
+            total[1] += stats.errors
+            total[2] += stats.total_time
+            total[3] = max(total[3], stats.max_time)
+        for host, count in connections.items():
+            totals.setdefault(host, [0, 0, 0.0, 0.0, 0])[4] += count
+    if not totals:
+        return "Исходящих запросов ещё не было"
+    text = "🌐 Исходящие соединения:\n"
+    for host, (count, errors, total_time, max_time, opened) in sorted(totals.items()):
+        avg = total_time / count * 1000 if count else 0
+        text += (f"\n{host}\nзапросов: {count}, ошибок: {errors}, соединений: {opened}\n"
+                 f"среднее: {avg:.0f} мс, максимум: {max_time * 1000:.0f} мс\n")
+    return text
+
+# Telegram: одна сессия на все потоки вместо новой сессии в каждом потоке
+apihelper.session = pooled_session()
+apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+
+# Запись входящего трафика для нагрузочных тестов (см. replay.py)
+TRAFFIC_RECORD_PATH = os.getenv('TRAFFIC_RECORD_PATH')
+if TRAFFIC_RECORD_PATH:
+    apihelper.ENABLE_MIDDLEWARE = True
+
 # Инициализация бота
 bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 
@@ -53,6 +189,8 @@ try:
     gs_scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
     creds = ServiceAccountCredentials.from_json_keyfile_name('credentials.json', gs_scope)
     client = gspread.authorize(creds)
+    pooled_session(client.session)
+    client.set_timeout((HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
     spreadsheet = client.open(SPREADSHEET_NAME)
     sheet = spreadsheet.sheet1
     SPREADSHEET_URL = spreadsheet.url
@@ -60,34 +198,571 @@ except Exception as e:
     logger.error(f"Ошибка при подключении к Google Sheets: {e}")
     sys.exit(1)
 
-# Инициализация Яндекс.Диска
+# Клиент Яндекс.Диска
+YADISK_API_URL = os.getenv('YADISK_API_URL')
+YADISK_MAX_PARALLEL = int(os.getenv('YADISK_MAX_PARALLEL', '4'))
+YADISK_DEFAULT_API_URL = 'https://cloud-api.yandex.net'
+
+class _ApiRedirectSession(requests.Session):
+    """Сессия, направляющая запросы к API на другой адрес (локальный тестовый сервер)"""
+
+    def __init__(self, api_url):
+        super().__init__()
+        self.api_url = api_url.rstrip('/')
+
+    def prepare_request(self, request):
+        if request.url.startswith(YADISK_DEFAULT_API_URL):
+            request.url = self.api_url + request.url[len(YADISK_DEFAULT_API_URL):]
+        return super().prepare_request(request)
+
+class YaDiskClient(yadisk.YaDisk):
+    """Обёртка над yadisk.YaDisk.
+
+    Переиспользует HTTP-соединения (по сессии на поток), помнит уже
+    существующие удалённые папки, пропускает загрузку, если на диске лежит
+    файл с тем же MD5 и размером, и умеет загружать несколько файлов
+    параллельно. Пути задаются относительно корневой папки бота.
+    """
+
+    def __init__(self, token, root, api_url=None, max_parallel=4):
+        super().__init__(token=token)
+        self.root = root.rstrip('/')
+        self.api_url = api_url
+        self.max_parallel = max_parallel
+        self.known_dirs = set()
+        self.dirs_lock = threading.Lock()
+        # Один пул на всё время работы: yadisk держит сессию на поток,
+        # и только постоянные потоки переиспользуют соединения между пакетами
+        self.pool = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='yadisk')
+
+    def make_session(self, token=None):
+        if token is None:
+            token = self.token
+        session = _ApiRedirectSession(self.api_url) if self.api_url else requests.Session()
+        # Ответы 5xx yadisk повторяет сам (n_retries), здесь — только ошибки соединения
+        pooled_session(session, max(self.max_parallel, 2), status_retries=0)
+        weakref.finalize(session, session.close)
+        if token:
+            session.headers['Authorization'] = 'OAuth ' + token
+        return session
+
+    def full_path(self, remote_path):
+        return f"{self.root}/{remote_path}" if remote_path else self.root
+
+    def ensure_dir(self, remote_dir):
+        """Создаёт удалённую папку (и родительские), если её ещё нет"""
+        path = ''
+        for part in self.full_path(remote_dir).strip('/').split('/'):
+            path = f"{path}/{part}" if path else part
+            if path in self.known_dirs:
+                continue
+            try:
+                self.mkdir(path)
+            except yadisk.exceptions.PathExistsError:
+                pass
+            with self.dirs_lock:
+                self.known_dirs.add(path)
+
+    def is_same(self, local_path, full_remote_path):
+        """Проверяет, совпадает ли файл на диске с локальным по размеру и MD5"""
+        try:
+            meta = self.get_meta(full_remote_path, fields=['md5', 'size'])
+        except yadisk.exceptions.PathNotFoundError:
+            return False
+        if meta.size != os.path.getsize(local_path):
+            return False
+        md5 = hashlib.md5()
+        with open(local_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                md5.update(chunk)
+        return meta.md5 == md5.hexdigest()
+
+    def upload_file(self, local_path, remote_path):
+        """Загружает файл; возвращает False, если такой файл уже есть на диске"""
+        self.ensure_dir(os.path.dirname(remote_path))
+        full_remote_path = self.full_path(remote_path)
+        if self.is_same(local_path, full_remote_path):
+            return False
+        self.upload(local_path, full_remote_path, overwrite=True)
+        return True
+
+    def upload_many(self, files):
+        """Параллельно загружает пары (local_path, remote_path), возвращает список успехов"""
+        def upload_one(pair):
+            try:
+                self.upload_file(*pair)
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка загрузки на Яндекс.Диск {pair[1]}: {e}")
+                return False
+
+        return list(self.pool.map(upload_one, files))
+
+    def download_file(self, remote_path, local_path):
+        self.download(self.full_path(remote_path), local_path)
+
+# Инициализация Яндекс.Диска (корневая папка создаётся при запуске, см. run_single / run_front)
 try:
-    y = yadisk.YaDisk(token=YANDEX_DISK_TOKEN)
-    if not y.exists(YANDEX_DISK_FOLDER):
-        y.mkdir(YANDEX_DISK_FOLDER)
+    y = YaDiskClient(YANDEX_DISK_TOKEN, YANDEX_DISK_FOLDER, YADISK_API_URL, YADISK_MAX_PARALLEL)
 except Exception as e:
     logger.error(f"Ошибка при подключении к Яндекс.Диску: {e}")
     sys.exit(1)
 
 def upload_to_yadisk(local_path, remote_path):
     try:
-        full_remote_path = f"{YANDEX_DISK_FOLDER}/{remote_path}"
-        y.upload(local_path, full_remote_path)
+        if not y.upload_file(local_path, remote_path):
+            logger.info(f"Файл на Яндекс.Диске не изменился, загрузка пропущена: {remote_path}")
         return True
     except Exception as e:
         logger.error(f"Ошибка загрузки на Яндекс.Диск: {e}")
         return False
 
+# Локальное хранилище файлов с вытеснением уже загруженных на Яндекс.Диск
+DATA_DIR = 'data'
+ARTIFACTS_INDEX_PATH = os.path.join(DATA_DIR, 'artifacts.json')
+ARTIFACTS_MAX_MB = int(os.getenv('ARTIFACTS_MAX_MB', '500'))
+ARTIFACTS_MIN_AGE = 60  # только что открытые файлы не вытесняются
+ARTIFACT_DIRS = ('photos', 'stickers', 'pdf_receipts')
+
+class ArtifactStore:
+    """Индекс локальных файлов (фото, стикеры, квитанции).
+
+    Для каждого файла хранится удалённый путь, размер, признак загрузки
+    на Яндекс.Диск и время последнего обращения. Когда локальные копии
+    превышают бюджет, удаляются давно не использованные и уже загруженные
+    файлы; при следующем обращении они скачиваются обратно. Индекс лежит
+    в общей SQLite-базе, поэтому бюджет один на все рабочие процессы.
+    """
+
+    def __init__(self, store, max_bytes, legacy_index_path=None):
+        self.store = store
+        self.max_bytes = max_bytes
+        with store.lock:
+            store.conn.execute(
+                'CREATE TABLE IF NOT EXISTS artifacts (path TEXT PRIMARY KEY, remote TEXT NOT NULL, '
+                'size INTEGER NOT NULL, uploaded INTEGER NOT NULL, local INTEGER NOT NULL, atime REAL NOT NULL)'
+            )
+        if legacy_index_path and os.path.exists(legacy_index_path):
+            self.import_legacy(legacy_index_path)
+
+    def import_legacy(self, index_path):
+        """Переносит индекс из artifacts.json прежних версий"""
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            with self.store.lock:
+                self.store.conn.executemany(
+                    'INSERT OR IGNORE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)',
+                    [(e['path'], e['remote'], e['size'], int(e['uploaded']), int(os.path.exists(e['path'])),
+                      e.get('atime', 0)) for e in data]
+                )
+            os.remove(index_path)
+        except Exception as e:
+            logger.error(f"Ошибка переноса индекса файлов: {e}")
+
+    def bootstrap(self, dirs):
+        """Один раз индексирует файлы, лежавшие в каталогах до появления индекса.
+
+        Удалённый путь совпадает с локальным; файл считается загруженным,
+        если на Яндекс.Диске лежит копия с тем же MD5. Остальные
+        догружаются через retry_uploads. Прерванный проход повторяется при
+        следующем запуске и пропускает уже внесённые файлы.
+        """
+        with self.store.lock:
+            done = self.store.conn.execute("SELECT value FROM counters WHERE name = 'artifacts_bootstrap'").fetchone()
+            known = {path for path, in self.store.conn.execute('SELECT path FROM artifacts')}
+        if done:
+            return
+        paths = [
+            f"{d}/{name}" for d in dirs if os.path.isdir(d) for name in sorted(os.listdir(d))
+            if os.path.isfile(f"{d}/{name}") and f"{d}/{name}" not in known
+        ]
+
+        def check(path):
+            try:
+                uploaded = y.is_same(path, y.full_path(path))
+            except Exception as e:
+                logger.error(f"Ошибка проверки {path} на Яндекс.Диске: {e}")
+                uploaded = False
+            return (path, path, os.path.getsize(path), int(uploaded), 1, os.path.getmtime(path))
+
+        entries = list(y.pool.map(check, paths))
+        with self.store.lock:
+            self.store.conn.executemany('INSERT OR IGNORE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)', entries)
+            self.store.conn.execute("INSERT OR REPLACE INTO counters VALUES ('artifacts_bootstrap', 1)")
+        logger.info(f"Проиндексировано старых файлов: {len(entries)}, уже на Яндекс.Диске: {sum(e[3] for e in entries)}")
+
+    def startup(self, dirs):
+        """Фоновая работа при запуске — только в одном процессе (обычном или фронтовом),
+        чтобы рабочие процессы не загружали одни и те же файлы одновременно"""
+        try:
+            self.bootstrap(dirs)
+            self.retry_uploads()
+        except Exception as e:
+            logger.error(f"Ошибка обслуживания хранилища файлов: {e}")
+
+    def put(self, local_path, remote_path):
+        """Регистрирует новый файл и загружает его на Яндекс.Диск"""
+        uploaded = upload_to_yadisk(local_path, remote_path)
+        with self.store.lock:
+            self.store.conn.execute(
+                'INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, 1, ?)',
+                (local_path, remote_path, os.path.getsize(local_path), int(uploaded), time.time())
+            )
+        self.evict(keep=local_path)
+        return uploaded
+
+    def get(self, local_path):
+        """Возвращает путь к локальной копии, при необходимости скачивая её с Яндекс.Диска"""
+        with self.store.lock:
+            row = self.store.conn.execute(
+                'SELECT remote, local FROM artifacts WHERE path = ?', (local_path,)
+            ).fetchone()
+            if row is None:
+                return local_path
+            self.store.conn.execute('UPDATE artifacts SET atime = ? WHERE path = ?', (time.time(), local_path))
+        remote_path, local = row
+        if local and os.path.exists(local_path):
+            return local_path
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        y.download_file(remote_path, local_path)
+        logger.info(f"Файл восстановлен с Яндекс.Диска: {local_path}")
+        with self.store.lock:
+            self.store.conn.execute('UPDATE artifacts SET local = 1 WHERE path = ?', (local_path,))
+        self.evict(keep=local_path)
+        return local_path
+
+    def retry_uploads(self):
+        """Повторяет загрузку файлов, которые не удалось отправить ранее"""
+        with self.store.lock:
+            pending = self.store.conn.execute(
+                'SELECT path, remote FROM artifacts WHERE uploaded = 0 AND local = 1'
+            ).fetchall()
+        if not pending:
+            return
+        results = y.upload_many(pending)
+        with self.store.lock:
+            self.store.conn.executemany(
+                'UPDATE artifacts SET uploaded = 1 WHERE path = ?',
+                [(path,) for (path, _), uploaded in zip(pending, results) if uploaded]
+            )
+        self.evict()
+
+    def evict(self, keep=None):
+        with self.store.lock:
+            conn = self.store.conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                local_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM artifacts WHERE local = 1').fetchone()[0]
+                if local_bytes > self.max_bytes:
+                    candidates = conn.execute(
+                        'SELECT path, size FROM artifacts WHERE local = 1 AND uploaded = 1 AND path != ? '
+                        'AND atime < ? ORDER BY atime',
+                        (keep or '', time.time() - ARTIFACTS_MIN_AGE)
+                    ).fetchall()
+                    for path, size in candidates:
+                        if local_bytes <= self.max_bytes:
+                            break
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                        except OSError as e:
+                            logger.error(f"Не удалось удалить локальный файл {path}: {e}")
+                            continue
+                        conn.execute('UPDATE artifacts SET local = 0 WHERE path = ?', (path,))
+                        local_bytes -= size
+                        logger.info(f"Локальная копия удалена (есть на Яндекс.Диске): {path}")
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+
 # Регистрация шрифта для PDF
 try:
     pdfmetrics.registerFont(TTFont('Arial', 'Arial.ttf'))
 except:
     logger.warning("Arial font not found, using default")
 
+# Общее хранилище для нескольких процессов бота (номера заявок и чаты клиентов)
+SHARED_DB_PATH = os.path.join(DATA_DIR, 'shared.db')
+
+class SharedStore:
+    """SQLite-хранилище, общее для всех рабочих процессов на одной машине"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS chats (aid INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS sla (aid INTEGER PRIMARY KEY, status TEXT NOT NULL, since REAL NOT NULL, '
+            'alerted INTEGER NOT NULL DEFAULT 0, seq INTEGER NOT NULL)'
+        )
+
+    def allocate_id(self, last_known_id=0):
+        """Атомарно выдаёт следующий номер заявки, не меньший last_known_id + 1"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute("INSERT OR IGNORE INTO counters VALUES ('application_id', 0)")
+                self.conn.execute(
+                    "UPDATE counters SET value = MAX(value, ?) + 1 WHERE name = 'application_id'",
+                    (last_known_id,)
+                )
+                value = self.conn.execute("SELECT value FROM counters WHERE name = 'application_id'").fetchone()[0]
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return value
+
+    def take_token(self, name, capacity, rate, reserve=0):
+        """Берёт токен из общего ведра, если после этого в нём останется не меньше reserve.
+
+        Возвращает (успех, сколько секунд ждать до следующей попытки).
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (name,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + max(0, now - row[1]) * rate)
+                ok = tokens - 1 >= reserve
+                if ok:
+                    tokens -= 1
+                self.conn.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)', (name, tokens, now))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return ok, 0 if ok else (reserve + 1 - tokens) / rate
+
+    def drain_tokens(self, name):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO buckets VALUES (?, 0, ?)', (name, time.time()))
+
+    def sla_set(self, aid, status, since, alerted=False):
+        """Записывает смену статуса заявки для SLA-таймеров"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute("INSERT OR IGNORE INTO counters VALUES ('sla_seq', 0)")
+                self.conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'sla_seq'")
+                seq = self.conn.execute("SELECT value FROM counters WHERE name = 'sla_seq'").fetchone()[0]
+                self.conn.execute('INSERT OR REPLACE INTO sla VALUES (?, ?, ?, ?, ?)', (aid, status, since, int(alerted), seq))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def sla_changes(self, after_seq):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT aid, status, since, alerted, seq FROM sla WHERE seq > ? ORDER BY seq', (after_seq,)
+            ).fetchall()
+
+    def sla_mark_alerted(self, aid):
+        with self.lock:
+            self.conn.execute('UPDATE sla SET alerted = 1 WHERE aid = ?', (aid,))
+
+    def current_id(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM counters WHERE name = 'application_id'").fetchone()
+        return row[0] if row else 0
+
+    def get_chat(self, aid):
+        with self.lock:
+            row = self.conn.execute('SELECT chat_id FROM chats WHERE aid = ?', (aid,)).fetchone()
+        return row[0] if row else None
+
+    def set_chat(self, aid, chat_id):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO chats VALUES (?, ?)', (aid, chat_id))
+
+class ChatIndex:
+    """Словарь «номер заявки → chat_id» поверх SharedStore"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __contains__(self, aid):
+        return self.store.get_chat(aid) is not None
+
+    def __getitem__(self, aid):
+        chat_id = self.store.get_chat(aid)
+        if chat_id is None:
+            raise KeyError(aid)
+        return chat_id
+
+    def __setitem__(self, aid, chat_id):
+        self.store.set_chat(aid, chat_id)
+
+    def get(self, aid, default=None):
+        chat_id = self.store.get_chat(aid)
+        return default if chat_id is None else chat_id
+
+shared_store = SharedStore(SHARED_DB_PATH)
+artifacts = ArtifactStore(shared_store, ARTIFACTS_MAX_MB * 1024 * 1024, ARTIFACTS_INDEX_PATH)
+
+# Ограничение обращений к Google Sheets: общая квота с приоритетами
+SHEETS_QUOTA_PER_MINUTE = int(os.getenv('SHEETS_QUOTA_PER_MINUTE', '60'))
+SHEETS_BURST = int(os.getenv('SHEETS_BURST', '20'))
+PRIORITY_WRITE, PRIORITY_STATUS, PRIORITY_STATS = 0, 1, 2
+# Доля ведра, которую нельзя занимать менее важным запросам, и предельное ожидание, с.
+# Обработчики работают в одном потоке (threaded=False): ожидание квоты останавливает
+# все чаты, поэтому ждёт только запись заявки, чтение сразу отвечает SheetsBusy.
+SHEETS_RESERVE = {PRIORITY_WRITE: 0, PRIORITY_STATUS: 0.2, PRIORITY_STATS: 0.5}
+SHEETS_MAX_WAIT = {PRIORITY_WRITE: 20, PRIORITY_STATUS: 0, PRIORITY_STATS: 0}
+sheets_context = threading.local()
+
+class SheetsBusy(Exception):
+    """Квота Google Sheets исчерпана, запрос не выполнен"""
+
+@contextlib.contextmanager
+def sheets_priority(priority):
+    """Задаёт приоритет обращений к таблице внутри блока"""
+    previous = getattr(sheets_context, 'priority', None)
+    sheets_context.priority = priority
+    try:
+        yield
+    finally:
+        sheets_context.priority = previous
+
+class SheetsGovernor:
+    """Токен-ведро под квоту Sheets API, общее для всех процессов бота.
+
+    Запись новых заявок может забрать ведро целиком, чтение статусов
+    оставляет резерв для записи, статистика — ещё больший резерв. При
+    ответе 429 ведро опустошается, чтобы все процессы притормозили.
+    """
+
+    def __init__(self, store, per_minute, burst):
+        self.store = store
+        self.capacity = burst
+        self.rate = per_minute / 60
+
+    def call(self, priority, func, *args, **kwargs):
+        deadline = time.monotonic() + SHEETS_MAX_WAIT[priority]
+        reserve = self.capacity * SHEETS_RESERVE[priority]
+        while True:
+            ok, wait = self.store.take_token('sheets', self.capacity, self.rate, reserve)
+            if not ok:
+                if time.monotonic() + wait > deadline:
+                    raise SheetsBusy(f"{func.__name__}: квота Google Sheets исчерпана")
+                time.sleep(wait)
+                continue
+            try:
+                return func(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                if e.response.status_code != 429:
+                    raise
+                logger.warning(f"Google Sheets 429 в {func.__name__}, притормаживаем")
+                self.store.drain_tokens('sheets')
+                if priority != PRIORITY_WRITE:
+                    raise SheetsBusy(str(e)) from e
+
+class GovernedWorksheet:
+    """Прокси листа: каждый вызов API проходит через SheetsGovernor"""
+
+    WRITE_METHODS = {'append_row', 'append_rows', 'update_cell', 'update', 'batch_update', 'delete_rows'}
+    STATS_METHODS = {'get_all_records', 'get_all_values'}
+
+    def __init__(self, worksheet, governor):
+        self.worksheet = worksheet
+        self.governor = governor
+
+    def __getattr__(self, name):
+        attr = getattr(self.worksheet, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            priority = getattr(sheets_context, 'priority', None)
+            if priority is None:
+                if name in self.WRITE_METHODS:
+                    priority = PRIORITY_WRITE
+                elif name in self.STATS_METHODS:
+                    priority = PRIORITY_STATS
+                else:
+                    priority = PRIORITY_STATUS
+            return self.governor.call(priority, attr, *args, **kwargs)
+        return call
+
+sheets_governor = SheetsGovernor(shared_store, SHEETS_QUOTA_PER_MINUTE, SHEETS_BURST)
+sheet = GovernedWorksheet(spreadsheet.sheet1, sheets_governor)
+
+# Архиватор удаляет строки из рабочего листа, и номера строк ниже сдвигаются.
+# Он держит эту блокировку весь проход, а обработчики мастера, которые ищут
+# строку и пишут в неё, берут её на время работы: оба действия происходят в
+# процессе мастера. Ждать архивацию обработчики не могут (поток опроса один),
+# поэтому через SHEET_ROWS_WAIT секунд мастер получает ответ «занято».
+sheet_rows_lock = threading.RLock()
+SHEET_ROWS_WAIT = 2
+ARCHIVE_BUSY_TEXT = "⏳ Идёт архивация заявок, повторите через минуту"
+
+def stable_rows(func):
+    @functools.wraps(func)
+    def wrapper(update, *args, **kwargs):
+        if not sheet_rows_lock.acquire(timeout=SHEET_ROWS_WAIT):
+            if isinstance(update, types.CallbackQuery):
+                bot.answer_callback_query(update.id, ARCHIVE_BUSY_TEXT)
+            else:
+                bot.send_message(update.chat.id, ARCHIVE_BUSY_TEXT)
+            return
+        try:
+            return func(update, *args, **kwargs)
+        finally:
+            sheet_rows_lock.release()
+    return wrapper
+
+# Защита от флуда: не больше CHAT_REQUESTS_PER_MINUTE тяжёлых запросов от одного чата
+CHAT_REQUESTS_PER_MINUTE = int(os.getenv('CHAT_REQUESTS_PER_MINUTE', '6'))
+
+class ChatRateLimiter:
+    """Токен-ведро на каждый чат (чат всегда обслуживает один процесс)"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def allow(self, chat_id):
+        """Возвращает (разрешено, через сколько секунд можно повторить)"""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(chat_id, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            ok = tokens >= 1
+            if ok:
+                tokens -= 1
+            self.buckets[chat_id] = (tokens, now)
+        return ok, 0 if ok else (1 - tokens) / self.rate
+
+chat_limiter = ChatRateLimiter(CHAT_REQUESTS_PER_MINUTE)
+
+def check_flood(message):
+    """True, если чат превысил лимит; клиенту уже отправлен ответ"""
+    ok, retry_after = chat_limiter.allow(message.chat.id)
+    if not ok:
+        bot.send_message(
+            message.chat.id,
+            f"⏳ Слишком много запросов. Попробуйте через {int(retry_after) + 1} сек.",
+            reply_markup=create_main_menu()
+        )
+    return not ok
+
+BUSY_TEXT = "⏳ Сервис сейчас перегружен. Пожалуйста, повторите через минуту."
+
 # Хранение состояний и данных
 user_states = {}
 application_data = {}
-user_chat_ids = {}
+user_chat_ids = ChatIndex(shared_store)
 
 class Application:
     def __init__(self):
@@ -103,6 +778,207 @@ class Application:
         self.date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         self.status = 'Новая'
 
+# Снимок состояния для тёплого перезапуска
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '25'))
+snapshot_sections = {}
+
+def register_snapshot(name, dump, load, merge=None):
+    """Регистрирует кэш, который сохраняется при остановке и восстанавливается при запуске.
+
+    merge(a, b) объединяет значения из снимков разных процессов; без него
+    берётся первое непустое значение.
+    """
+    snapshot_sections[name] = (dump, load, merge)
+
+def save_snapshot(name, pending_updates=None, with_sections=True):
+    """Сохраняет незавершённые диалоги, кэши и необработанные обновления"""
+    chats = {}
+    for chat_id in set(user_states) | set(application_data):
+        app = application_data.get(chat_id)
+        chats[str(chat_id)] = {
+            'state': user_states.get(chat_id),
+            'application': app.__dict__ if app else None
+        }
+    sections = {}
+    for section, (dump, _, _) in snapshot_sections.items():
+        if not with_sections:
+            break
+        try:
+            sections[section] = dump()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения кэша {section}: {e}")
+    path = os.path.join(DATA_DIR, f'snapshot-{name}.json')
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({
+                'chats': chats,
+                'sections': sections,
+                'pending_updates': pending_updates or []
+            }, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+        logger.info(f"Snapshot saved: {path} ({len(chats)} chats, {len(pending_updates or [])} updates)")
+    except Exception as e:
+        logger.error(f"Ошибка сохранения снимка состояния: {e}")
+
+def load_snapshots():
+    """Читает и удаляет все сохранённые снимки, объединяя их в один"""
+    merged = {'chats': {}, 'sections': {}, 'pending_updates': []}
+    for path in sorted(glob.glob(os.path.join(DATA_DIR, 'snapshot-*.json'))):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            merged['chats'].update(data.get('chats', {}))
+            merged['pending_updates'].extend(data.get('pending_updates', []))
+            for section, value in data.get('sections', {}).items():
+                if value is None:
+                    continue
+                previous = merged['sections'].get(section)
+                merge = snapshot_sections.get(section, (None, None, None))[2]
+                if previous is not None and merge:
+                    value = merge(previous, value)
+                elif previous is not None:
+                    continue
+                merged['sections'][section] = value
+        except Exception as e:
+            logger.error(f"Ошибка чтения снимка {path}: {e}")
+        finally:
+            os.remove(path)
+    merged['pending_updates'].sort(key=lambda u: u['update_id'])
+    return merged
+
+def apply_snapshot(snapshot):
+    """Восстанавливает диалоги и кэши из снимка"""
+    for chat_id, chat in snapshot['chats'].items():
+        chat_id = int(chat_id)
+        if chat['state'] is not None:
+            user_states[chat_id] = chat['state']
+        if chat['application'] is not None:
+            app = Application()
+            app.__dict__.update(chat['application'])
+            application_data[chat_id] = app
+    for section, value in snapshot['sections'].items():
+        if section in snapshot_sections:
+            try:
+                snapshot_sections[section][1](value)
+            except Exception as e:
+                logger.error(f"Ошибка восстановления кэша {section}: {e}")
+    if snapshot['chats']:
+        logger.info(f"Restored {len(snapshot['chats'])} conversations from snapshot")
+
+register_snapshot(
+    'yadisk_dirs', lambda: sorted(y.known_dirs), lambda dirs: y.known_dirs.update(dirs),
+    lambda a, b: sorted(set(a) | set(b))
+)
+
+def confirm_updates(offset):
+    """Подтверждает Telegram получение обновлений до offset, чтобы они не пришли повторно"""
+    try:
+        apihelper.get_updates(BOT_TOKEN, offset, 1, 5, long_polling_timeout=1)
+    except Exception as e:
+        logger.error(f"Не удалось подтвердить обновления: {e}")
+
+class TrafficRecorder:
+    """Пишет входящие обновления в JSONL в обезличенном виде.
+
+    Идентификаторы пользователей и чатов заменяются стабильными хешами
+    (мастер всегда получает id 1), имена, подписи и геоданные удаляются,
+    длинные последовательности цифр (телефоны в любой записи) заменяются
+    на вымышленные той же формы. Текст шага «имя» и запросы /find
+    заменяются целиком, в свободном тексте шагов «неисправность»,
+    «комментарий» и «телефон» буквы заменяются на x. Команды мастера
+    с номерами заявок остаются как есть, иначе их нельзя воспроизвести.
+    """
+
+    # 9 и больше цифр подряд, допускаются пробелы, дефисы и скобки между ними
+    LONG_NUMBER = re.compile(r'\+?\d(?:[\s\-()]*\d){8,}')
+    # Номера и диапазоны заявок, а не телефоны
+    PLAIN_TEXT = ('/setstatus', '/money')
+    PLAIN_DATA = ('accept_', 'reject_')
+    # Шаги, на которых клиент пишет произвольный текст
+    FREE_TEXT_STATES = ('problem', 'comment', 'phone')
+
+    def __init__(self, path, salt=''):
+        self.path = path
+        self.salt = salt
+        self.lock = threading.Lock()
+        self.update_id = 0
+
+    def anon_id(self, value):
+        if value == MASTER_ID:
+            return 1
+        digest = hashlib.sha256(f"{self.salt}:{value}".encode()).hexdigest()
+        return 1000000 + int(digest[:8], 16) % 1000000000
+
+    def anon_phone(self, match):
+        """Меняет все цифры, кроме первой (+7 / 8), сохраняя разделители и длину"""
+        number = match.group(0)
+        digits = re.sub(r'\D', '', number)
+        digest = hashlib.sha256(f"{self.salt}:{digits}".encode()).hexdigest()
+        fake = iter(str(int(digest, 16)))
+        first = re.search(r'\d', number).start()
+        return number[:first + 1] + re.sub(r'\d', lambda _: next(fake), number[first + 1:])
+
+    def anonymize(self, obj):
+        if isinstance(obj, list):
+            return [self.anonymize(v) for v in obj]
+        if not isinstance(obj, dict):
+            return obj
+        result = {}
+        for key, value in obj.items():
+            if key in ('first_name', 'last_name', 'username', 'title'):
+                result[key] = 'User' if key == 'first_name' else None
+            elif key in ('caption', 'contact', 'caption_entities', 'location', 'venue'):
+                continue
+            elif key in ('from', 'chat', 'user') and isinstance(value, dict):
+                result[key] = self.anonymize(dict(value, id=self.anon_id(value.get('id'))))
+            elif key in ('file_id', 'file_unique_id'):
+                result[key] = hashlib.sha256(f"{self.salt}:{value}".encode()).hexdigest()[:32]
+            elif key in ('text', 'data') and isinstance(value, str):
+                plain = self.PLAIN_TEXT if key == 'text' else self.PLAIN_DATA
+                result[key] = value if value.startswith(plain) else self.LONG_NUMBER.sub(self.anon_phone, value)
+            else:
+                result[key] = self.anonymize(value)
+        return {k: v for k, v in result.items() if v is not None}
+
+    def record(self, update_type, obj):
+        data = self.anonymize(obj)
+        # Личные данные вводятся обычным текстом — узнаём их по шагу диалога
+        if update_type == 'message' and 'text' in data:
+            state = user_states.get(obj['chat']['id'])
+            if state == 'name':
+                data['text'] = 'Клиент'
+            elif state in self.FREE_TEXT_STATES:
+                # Цифры уже заменены; буквы убираем, длина и форма ввода сохраняются
+                data['text'] = re.sub(r'[^\W\d_]', 'x', data['text'])
+            elif data['text'].startswith('/find'):
+                data['text'] = '/find Клиент'
+        with self.lock:
+            self.update_id += 1
+            line = json.dumps(
+                {'ts': time.time(), 'update': {'update_id': self.update_id, update_type: data}},
+                ensure_ascii=False
+            )
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+if TRAFFIC_RECORD_PATH:
+    traffic_recorder = TrafficRecorder(TRAFFIC_RECORD_PATH, os.getenv('TRAFFIC_SALT', ''))
+
+    @bot.middleware_handler(update_types=['message'])
+    def record_message(bot_instance, message):
+        try:
+            traffic_recorder.record('message', message.json)
+        except Exception as e:
+            logger.error(f"Ошибка записи трафика: {e}")
+
+    @bot.middleware_handler(update_types=['callback_query'])
+    def record_callback_query(bot_instance, call):
+        try:
+            traffic_recorder.record('callback_query', call.json)
+        except Exception as e:
+            logger.error(f"Ошибка записи трафика: {e}")
+
 # Клавиатуры
 def create_main_menu():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
@@ -228,7 +1104,7 @@ def handle_photo(message):
         
         # Загрузка фото на Яндекс.Диск
         remote_path = f"photos/{os.path.basename(path)}"
-        if upload_to_yadisk(path, remote_path):
+        if artifacts.put(path, remote_path):
             logger.info(f"Фото загружено на Яндекс.Диск: {remote_path}")
         
         user_states[message.chat.id] = 'preview'
@@ -256,7 +1132,7 @@ def show_preview(message):
         kb.add('да','нет')
         
         if app.photo:
-            with open(app.photo,'rb') as photo:
+            with open(artifacts.get(app.photo),'rb') as photo:
                 bot.send_photo(message.chat.id, photo, caption=text, reply_markup=kb)
         else:
             bot.send_message(message.chat.id, text, reply_markup=kb)
@@ -274,16 +1150,15 @@ def handle_preview_confirm(message):
         
         app = application_data[message.chat.id]
         
-        try:
-            vals = sheet.get_all_values()
-            if len(vals) > 1:
-                last_id = vals[-1][0].strip()
-                app.id = int(last_id) + 1 if last_id else 1
-            else:
-                app.id = 1
-        except Exception as e:
-            logger.error(f"Ошибка при генерации ID: {e}")
-            app.id = 1
+        if app.id is None:
+            try:
+                with sheets_priority(PRIORITY_WRITE):
+                    vals = sheet.get_all_values()
+                last_id = vals[-1][0].strip() if len(vals) > 1 else ''
+                app.id = shared_store.allocate_id(max(int(last_id) if last_id else 0, archive_store.max_id()))
+            except Exception as e:
+                logger.error(f"Ошибка при генерации ID: {e}")
+                app.id = shared_store.allocate_id()
         
         user_chat_ids[app.id] = app.chat_id
         
@@ -295,6 +1170,11 @@ def handle_preview_confirm(message):
         
         try:
             sheet.append_row(row)
+            sla_track(app.id, app.status, parse_date(app.date).timestamp())
+            search_index.add(app.id, {
+                'date': app.date, 'name': app.name, 'phone': app.phone, 'device_type': app.device_type,
+                'device_model': app.device_model, 'problem': app.problem, 'status': app.status
+            })
             send_to_master(app)
             bot.send_message(
                 app.chat_id, 
@@ -304,6 +1184,14 @@ def handle_preview_confirm(message):
                 '📄 Вы получите квитанцию о приёме после осмотра', 
                 reply_markup=create_main_menu()
             )
+        except SheetsBusy as e:
+            # Заявка остаётся в состоянии предпросмотра — клиент может повторить «да»
+            logger.warning(f"Заявка #{app.id} не сохранена: {e}")
+            bot.send_message(
+                app.chat_id,
+                "⏳ Сервис сейчас перегружен, заявка не потеряна. Отправьте «да» ещё раз через минуту."
+            )
+            return
         except Exception as e:
             logger.error(f"Ошибка при сохранении в Google Sheets: {e}")
             bot.send_message(
@@ -334,17 +1222,31 @@ def send_to_master(app):
         )
 
         if app.photo:
-            with open(app.photo,'rb') as photo:
+            with open(artifacts.get(app.photo),'rb') as photo:
                 bot.send_photo(MASTER_ID, photo, caption=msg, reply_markup=kb)
         else:
             bot.send_message(MASTER_ID, msg, reply_markup=kb)
         
+        if print_label(app):
+            bot.send_message(MASTER_ID, f"🖨 Стикер #{app.id} отправлен на принтер")
+            return
         sticker_path = generate_sticker_pdf(app)
-        with open(sticker_path,'rb') as sticker:
+        with open(artifacts.get(sticker_path),'rb') as sticker:
             bot.send_document(MASTER_ID, sticker, caption=f"Стикер #{app.id}")
     except Exception as e:
         logger.error(f"Ошибка в send_to_master: {e}")
 
+# Текст стикера (общий для PDF и термопринтера)
+def sticker_lines(app):
+    date_str = datetime.now().strftime("%d-%m")
+    return [
+        f"ID: {app.id}",
+        f"Дата: {date_str}",
+        f"Клиент: {app.name[:14]}" if len(app.name) > 14 else f"Клиент: {app.name}",
+        f"Тел: {app.phone}",
+        f"Пробл: {app.problem[:20] + '...' if len(app.problem) > 20 else app.problem}"
+    ]
+
 # Генерация стикера в PDF
 def generate_sticker_pdf(app):
     try:
@@ -361,19 +1263,12 @@ def generate_sticker_pdf(app):
         font_size_mm = 2.2
         font_size_px = int(font_size_mm * mm_to_px)
         try:
-            font = ImageFont.truetype('arial.ttf', font_size_px)
-        except:
-            font = ImageFont.load_default()
-            font.size = font_size_px
-
-        date_str = datetime.now().strftime("%d-%m")
-        lines = [
-            f"ID: {app.id}",
-            f"Дата: {date_str}",
-            f"Клиент: {app.name[:14]}" if len(app.name) > 14 else f"Клиент: {app.name}",
-            f"Тел: {app.phone}",
-            f"Пробл: {app.problem[:20] + '...' if len(app.problem) > 20 else app.problem}"
-        ]
+            font = ImageFont.truetype('Arial.ttf', font_size_px)
+        except OSError:
+            # Встроенный шрифт PIL не умеет кириллицу
+            font = ImageFont.truetype('DejaVuSans.ttf', font_size_px)
+
+        lines = sticker_lines(app)
 
         text_margin_mm = 2.3
         text_margin_px = int(text_margin_mm * mm_to_px)
@@ -422,7 +1317,7 @@ def generate_sticker_pdf(app):
         
         # Загрузка стикера на Яндекс.Диск
         remote_path = f"stickers/{os.path.basename(pdf_path)}"
-        if upload_to_yadisk(pdf_path, remote_path):
+        if artifacts.put(pdf_path, remote_path):
             logger.info(f"Стикер загружен на Яндекс.Диск: {remote_path}")
         
         return pdf_path
@@ -431,16 +1326,106 @@ def generate_sticker_pdf(app):
         logger.error(f"Ошибка генерации стикера: {str(e)}")
         raise RuntimeError("Не удалось создать стикер")
 
+# Печать стикера на термопринтере командами самого принтера (ZPL или ESC/POS).
+# LABEL_PRINTER: tcp://host:9100, путь к устройству (/dev/usb/lp0) или к файлу;
+# если задан каталог, каждый стикер пишется в отдельный файл.
+LABEL_FORMAT = os.getenv('LABEL_FORMAT', 'pdf').lower()
+LABEL_PRINTER = os.getenv('LABEL_PRINTER', '')
+LABEL_ZPL_DPMM = int(os.getenv('LABEL_ZPL_DPMM', '8'))  # 8 точек/мм = 203 dpi
+LABEL_ZPL_FONT = os.getenv('LABEL_ZPL_FONT', 'E:TT0003M_.TTF')  # шрифт с кириллицей
+LABEL_ESCPOS_CODEPAGE = int(os.getenv('LABEL_ESCPOS_CODEPAGE', '17'))  # 17 = PC866
+LABEL_TIMEOUT = 5
+
+def zpl_field(text):
+    """Экранирует данные поля для ^FH: символы ^, ~ и _ заменяются на _XX"""
+    for char in '_^~':
+        text = text.replace(char, f"_{ord(char):02X}")
+    return text
+
+def build_zpl_label(app):
+    """Стикер 40×30 мм в ZPL: текст слева, QR-код со ссылкой на таблицу справа"""
+    dots = lambda mm: int(mm * LABEL_ZPL_DPMM)
+    width, height = dots(40), dots(30)
+    qr_size, qr_margin = dots(16), dots(2)
+    text_margin, line_spacing, font_size = dots(2.3), dots(4.5), dots(2.2)
+    qr_scale = max(1, qr_size // 37)  # 37 модулей — QR версии 5 со ссылкой на таблицу
+
+    zpl = f"^XA^CI28^PW{width}^LL{height}^LH0,0"
+    y_position = text_margin
+    for line in sticker_lines(app):
+        # Строки рядом с QR-кодом обрезаются по его левому краю
+        text_width = width - qr_size - qr_margin * 2 - text_margin
+        if y_position > qr_margin + qr_size:
+            text_width = width - text_margin * 2
+        zpl += (f"^FO{text_margin},{y_position}^A@N,{font_size},{font_size},{LABEL_ZPL_FONT}"
+                f"^FB{text_width},1,0,L^FH_^FD{zpl_field(line)}^FS")
+        y_position += line_spacing
+    zpl += f"^FO{width - qr_size - qr_margin},{qr_margin}^BQN,2,{qr_scale}^FH_^FDMA,{zpl_field(SPREADSHEET_URL)}^FS"
+    zpl += "^PQ1^XZ"
+    return zpl.encode('utf-8')
+
+def build_escpos_label(app):
+    """Стикер для чекового принтера ESC/POS: строки текста и QR-код встроенными командами"""
+    qr_data = SPREADSHEET_URL.encode('ascii')
+    store_length = len(qr_data) + 3
+    payload = bytearray(b'\x1b@')                                  # ESC @ — сброс
+    payload += bytes([0x1b, 0x74, LABEL_ESCPOS_CODEPAGE])           # ESC t — кодовая страница
+    for line in sticker_lines(app):
+        payload += line.encode('cp866', 'replace') + b'\n'
+    payload += b'\x1ba\x01'                                         # ESC a 1 — по центру
+    payload += b'\x1d(k\x04\x001A2\x00'                             # QR: модель 2
+    payload += b'\x1d(k\x03\x001C\x04'                              # размер модуля 4
+    payload += b'\x1d(k\x03\x001E1'                                  # коррекция ошибок M
+    payload += b'\x1d(k' + bytes([store_length % 256, store_length // 256]) + b'1P0' + qr_data
+    payload += b'\x1d(k\x03\x001Q0'                                  # печать QR
+    payload += b'\x1ba\x00\n\n\n'
+    payload += b'\x1dVB\x00'                                         # GS V — отрезать бумагу
+    return bytes(payload)
+
+LABEL_BUILDERS = {'zpl': build_zpl_label, 'escpos': build_escpos_label}
+
+def send_to_printer(payload, name):
+    """Отправляет готовые команды на принтер: по TCP (RAW, порт 9100), в устройство или файл"""
+    if LABEL_PRINTER.startswith('tcp://'):
+        host, _, port = LABEL_PRINTER[len('tcp://'):].partition(':')
+        with socket.create_connection((host, int(port or 9100)), timeout=LABEL_TIMEOUT) as conn:
+            conn.sendall(payload)
+    elif os.path.isdir(LABEL_PRINTER):
+        with open(os.path.join(LABEL_PRINTER, name), 'wb') as f:
+            f.write(payload)
+    else:
+        with open(LABEL_PRINTER, 'ab') as f:
+            f.write(payload)
+
+def print_label(app):
+    """Печатает стикер на термопринтере; False — печать не настроена или не удалась (нужен PDF)"""
+    builder = LABEL_BUILDERS.get(LABEL_FORMAT)
+    if builder is None or not LABEL_PRINTER:
+        return False
+    try:
+        send_to_printer(builder(app), f"стикер ({app.id}).{LABEL_FORMAT}")
+        logger.info(f"Стикер #{app.id} отправлен на принтер ({LABEL_FORMAT})")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка печати стикера #{app.id}: {e}")
+        return False
+
 # Обработка действий мастера
 @bot.callback_query_handler(func=lambda c: c.data.startswith(('accept_','reject_')))
+@stable_rows
 def handle_master_action(call):
     try:
         action, sid = call.data.split('_')
         aid = int(sid)
         
         try:
-            cell = sheet.find(str(aid))
+            # Поиск строки — часть записи мастера, а не чтение статуса клиентом
+            with sheets_priority(PRIORITY_WRITE):
+                cell = sheet.find(str(aid), in_column=1)
             row = cell.row
+        except SheetsBusy:
+            bot.answer_callback_query(call.id, "Сервис перегружен, попробуйте через минуту")
+            return
         except Exception as e:
             logger.error(f"Не найдена заявка #{aid}: {e}")
             bot.answer_callback_query(call.id, "Заявка не найдена")
@@ -449,6 +1434,9 @@ def handle_master_action(call):
         if action == 'accept':
             try:
                 sheet.update_cell(row, 10, 'Принято')
+                search_index.update_status(aid, 'Принято')
+                sla_track(aid, 'Принято')
+                report_cache.invalidate(aid)
                 
                 pdf_filename = f"Квитанция_№{aid}.pdf"
                 pdf_path = f"pdf_receipts/{pdf_filename}"
@@ -457,7 +1445,7 @@ def handle_master_action(call):
                 
                 # Загрузка квитанции на Яндекс.Диск
                 remote_path = f"pdf_receipts/{pdf_filename}"
-                if upload_to_yadisk(pdf_path, remote_path):
+                if artifacts.put(pdf_path, remote_path):
                     logger.info(f"Квитанция загружена на Яндекс.Диск: {remote_path}")
                 
                 message_text = (
@@ -468,7 +1456,7 @@ def handle_master_action(call):
                 )
                 
                 if aid in user_chat_ids:
-                    with open(pdf_path, 'rb') as f:
+                    with open(artifacts.get(pdf_path), 'rb') as f:
                         bot.send_document(
                             user_chat_ids[aid],
                             (pdf_filename, f),
@@ -483,6 +1471,9 @@ def handle_master_action(call):
                 
         else:
             sheet.update_cell(row, 10, 'Отклонено')
+            search_index.update_status(aid, 'Отклонено')
+            sla_track(aid, 'Отклонено')
+            report_cache.invalidate(aid)
             if aid in user_chat_ids:
                 bot.send_message(
                     user_chat_ids[aid],
@@ -497,8 +1488,10 @@ def handle_master_action(call):
 # Генерация PDF квитанции
 def create_pdf(aid, output_path):
     try:
-        cell = sheet.find(str(aid))
-        data = sheet.row_values(cell.row)
+        # Статус уже записан, квитанция — продолжение той же записи: ждём квоту, а не бросаем на полпути
+        with sheets_priority(PRIORITY_WRITE):
+            cell = sheet.find(str(aid))
+            data = sheet.row_values(cell.row)
         
         c = canvas.Canvas(output_path, pagesize=A4)
         
@@ -549,16 +1542,34 @@ def handle_check(message):
         return
     try:
         aid = int(message.text)
+        if check_flood(message):
+            return
         try:
-            cell = sheet.find(str(aid))
-            row = cell.row
-            status = sheet.cell(row,10).value
-            cost = sheet.cell(row,11).value
+            data = archive_store.get(aid)
+            # Архиватор может удалить строки между find и row_values (блокировка
+            # sheet_rows_lock есть только в процессе мастера) — сверяем ID строки
+            # и при сдвиге ищем заново: заявка могла как раз уйти в архив
+            for _ in range(2):
+                if data is not None:
+                    break
+                cell = sheet.find(str(aid), in_column=1)
+                row = sheet.row_values(cell.row) if cell else []
+                if row and row[0].strip() == str(aid):
+                    data = row
+                else:
+                    data = archive_store.get(aid)
+            if data is None:
+                raise LookupError(aid)
+            data = data + ['', '']
+            status = data[9]
+            cost = data[10]
             icons = {'Новая':'🟡','Принято':'🟡','В работе':'🟠','Готово':'🟢','Отклонено':'🔴'}
             text = f"{icons.get(status, '')}{status}"
             if status=='Готово' and cost and cost!='':
                 text += f"\nК оплате: {cost} руб. Свяжитесь с мастером."
             bot.send_message(message.chat.id, text, reply_markup=create_main_menu())
+        except SheetsBusy:
+            bot.send_message(message.chat.id, BUSY_TEXT, reply_markup=create_main_menu())
         except:
             bot.send_message(message.chat.id, 'ID не найден.', reply_markup=create_main_menu())
     except ValueError:
@@ -638,65 +1649,177 @@ def show_channel(message):
     bot.send_message(message.chat.id, "Наш канал: t.me/robotfixservice")
 
 # Команды для мастера
+STATUS_COLUMN = 10
+COST_COLUMN = 11
+BULK_MAX_IDS = 200
+NOTIFY_PARALLEL = 8
+# Статусы с клавиатуры /setstatus; в команде принимаются без учёта регистра
+STATUS_CHOICES = {s.lower(): s for s in ('Принято', 'В работе', 'Готово', 'Выдано', 'Отклонено')}
+
+def parse_id_list(spec):
+    """'12-20,25' -> [12, 13, ..., 20, 25]"""
+    ids = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = map(int, part.split('-', 1))
+            if end < start:
+                raise ValueError(part)
+            # Размер диапазона проверяем до того, как его разворачивать
+            if len(ids) + end - start + 1 > BULK_MAX_IDS:
+                raise ValueError(f"Не больше {BULK_MAX_IDS} заявок за раз")
+            ids.extend(range(start, end + 1))
+        else:
+            ids.append(int(part))
+        if len(ids) > BULK_MAX_IDS:
+            raise ValueError(f"Не больше {BULK_MAX_IDS} заявок за раз")
+    if not ids:
+        raise ValueError(spec)
+    return list(dict.fromkeys(ids))
+
+def resolve_rows(ids):
+    """Номера строк и стоимость заявок одним запросом к таблице (перед записью мастера)"""
+    wanted = set(ids)
+    with sheets_priority(PRIORITY_WRITE):
+        id_column, cost_column = sheet.batch_get(['A:A', 'K:K'])
+    rows = {}
+    for row, values in enumerate(id_column, start=1):
+        value = values[0].strip() if values else ''
+        if value.isdigit() and int(value) in wanted:
+            rows[int(value)] = row
+    costs = {}
+    for aid, row in rows.items():
+        values = cost_column[row - 1] if row - 1 < len(cost_column) else []
+        costs[aid] = values[0] if values else ''
+    return rows, costs
+
+def update_cells(rows, column, values):
+    """Одна пакетная запись: {aid: строка}, {aid: значение}"""
+    sheet.batch_update([
+        {'range': gspread.utils.rowcol_to_a1(row, column), 'values': [[values[aid]]]}
+        for aid, row in rows.items()
+    ], value_input_option='USER_ENTERED')
+
+def notify_clients(messages):
+    """Параллельно отправляет уведомления [(chat_id, текст)], возвращает число доставленных"""
+    def send(item):
+        try:
+            bot.send_message(*item)
+            return True
+        except Exception as e:
+            logger.error(f"Не удалось уведомить клиента {item[0]}: {e}")
+            return False
+
+    if not messages:
+        return 0
+    with ThreadPoolExecutor(max_workers=NOTIFY_PARALLEL) as pool:
+        return sum(pool.map(send, messages))
+
+def format_ids(ids):
+    return ', '.join(f"#{aid}" for aid in ids)
+
+def bulk_set_status(chat_id, ids, new_status):
+    """Меняет статус нескольких заявок и отправляет мастеру одну сводку"""
+    rows, costs = resolve_rows(ids)
+    if rows:
+        update_cells(rows, STATUS_COLUMN, {aid: new_status for aid in rows})
+    for aid in rows:
+        search_index.update_status(aid, new_status)
+        report_cache.invalidate(aid)
+        sla_track(aid, new_status)
+
+    messages = []
+    if new_status == 'Готово':
+        for aid in rows:
+            client_chat_id = user_chat_ids.get(aid)
+            if client_chat_id is None:
+                continue
+            note = '🟢 Ваше устройство готово.'
+            if costs[aid]:
+                note += f"\nК оплате: {costs[aid]} руб. Свяжитесь с мастером чтоб забрать устройство."
+            messages.append((client_chat_id, note))
+    notified = notify_clients(messages)
+
+    missing = [aid for aid in ids if aid not in rows]
+    archived = [aid for aid in missing if archive_store.get(aid) is not None]
+    missing = [aid for aid in missing if aid not in archived]
+    if len(ids) == 1:
+        if rows:
+            text = f"#{ids[0]} => {new_status}"
+        elif archived:
+            text = f"Заявка #{ids[0]} уже в архиве"
+        else:
+            text = f"Заявка #{ids[0]} не найдена"
+    else:
+        text = f"{new_status}: обновлено {len(rows)} из {len(ids)}"
+        if rows:
+            text += f"\n✅ {format_ids(rows)}"
+        if archived:
+            text += f"\n🗄 В архиве: {format_ids(archived)}"
+        if missing:
+            text += f"\n⚠️ Не найдены: {format_ids(missing)}"
+        if messages:
+            text += f"\n📨 Уведомлено клиентов: {notified} из {len(messages)}"
+    bot.send_message(chat_id, text, reply_markup=create_main_menu())
+
 @bot.message_handler(commands=['setstatus'])
+@stable_rows
 def set_status(message):
     if message.from_user.id != MASTER_ID: 
         return
     
     try:
-        parts = message.text.split()
+        parts = message.text.split(maxsplit=2)
         if len(parts) < 2: 
-            return bot.send_message(message.chat.id, 'Используйте: /setstatus [ID]')
+            return bot.send_message(message.chat.id, 'Используйте: /setstatus [ID] или /setstatus 12-20,25 [статус]')
         
-        aid = int(parts[1])
-        user_states[message.chat.id] = f'set_{aid}'
+        ids = parse_id_list(parts[1])
+        if len(parts) == 3:
+            status = STATUS_CHOICES.get(parts[2].strip().lower())
+            if status is None:
+                return bot.send_message(
+                    message.chat.id,
+                    f"Неизвестный статус «{parts[2].strip()}». Допустимые: {', '.join(STATUS_CHOICES.values())}\n"
+                    f"Список ID пишется без пробелов: /setstatus 12,13 Готово"
+                )
+            return bulk_set_status(message.chat.id, ids, status)
+
+        user_states[message.chat.id] = f'set_{parts[1]}'
         
         kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        kb.add('Принято','В работе','Готово','Выдано','Отклонено')
+        kb.add(*STATUS_CHOICES.values())
         
         bot.send_message(message.chat.id, 'Выберите статус:', reply_markup=kb)
     except ValueError:
-        bot.send_message(message.chat.id, 'ID должен быть числом')
+        bot.send_message(message.chat.id, f'ID должен быть числом или списком (12-20,25), не больше {BULK_MAX_IDS}')
+    except SheetsBusy:
+        bot.send_message(message.chat.id, BUSY_TEXT, reply_markup=create_main_menu())
     except Exception as e:
         logger.error(f"Ошибка в set_status: {e}")
         bot.send_message(message.chat.id, 'Произошла ошибка')
 
 @bot.message_handler(func=lambda m: isinstance(user_states.get(m.chat.id), str) and user_states[m.chat.id].startswith('set_'))
+@stable_rows
 def handle_set_status(message):
     if message.from_user.id != MASTER_ID: 
         user_states.pop(message.chat.id, None)
         return
     
     try:
-        aid = int(user_states[message.chat.id].split('_')[1])
-        new_status = message.text
-        
-        try:
-            cell = sheet.find(str(aid))
-            row = cell.row
-            sheet.update_cell(row, 10, new_status)
-            
-            bot.send_message(
-                message.chat.id, 
-                f"#{aid} => {new_status}", 
-                reply_markup=create_main_menu()
-            )
-            
-            if new_status == 'Готово' and aid in user_chat_ids:
-                cost = sheet.cell(row, 11).value
-                note = '🟢 Ваше устройство готово.'
-                if cost and cost != '': 
-                    note += f"\nК оплате: {cost} руб. Свяжитесь с мастером чтоб забрать устройство."
-                bot.send_message(user_chat_ids[aid], note)
-                
-        except Exception as e:
-            logger.error(f"Не найдена заявка #{aid}: {e}")
-            bot.send_message(
+        ids = parse_id_list(user_states[message.chat.id].split('_', 1)[1])
+        status = STATUS_CHOICES.get((message.text or '').strip().lower())
+        if status is None:
+            return bot.send_message(
                 message.chat.id,
-                f"Заявка #{aid} не найдена",
+                f"Неизвестный статус «{message.text}». Допустимые: {', '.join(STATUS_CHOICES.values())}\n"
+                f"Повторите /setstatus и выберите статус на клавиатуре",
                 reply_markup=create_main_menu()
             )
-            
+        bulk_set_status(message.chat.id, ids, status)
+    except SheetsBusy:
+        bot.send_message(message.chat.id, BUSY_TEXT, reply_markup=create_main_menu())
     except Exception as e:
         logger.error(f"Ошибка в handle_set_status: {e}")
         bot.send_message(
@@ -707,117 +1830,12 @@ def handle_set_status(message):
     finally:
         user_states.pop(message.chat.id, None)
 
-@bot.message_handler(commands=['mystat'])
-def mystat(message):
-    if message.from_user.id != MASTER_ID: 
-        return
-    
-    try:
-        # Создаем клавиатуру для выбора периода
-        kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        kb.row('📊 Общая статистика')
-        kb.row('📅 За текущий месяц', '📅 За прошлый месяц')
-        kb.row('📆 За все время', '🔙 Назад')
-        
-        bot.send_message(
-            message.chat.id,
-            "Выберите период для статистики:",
-            reply_markup=kb
-        )
-        user_states[message.chat.id] = 'stat_period'
-    except Exception as e:
-        logger.error(f"Ошибка в mystat: {e}")
-        bot.send_message(message.chat.id, "Не удалось загрузить статистику", reply_markup=create_main_menu())
-
-@bot.message_handler(func=lambda m: user_states.get(m.chat.id) == 'stat_period')
-def handle_stat_period(message):
-    if message.text == '🔙 Назад':
-        bot.send_message(message.chat.id, "Возвращаемся в главное меню", reply_markup=create_main_menu())
-        user_states.pop(message.chat.id, None)
-        return
-    
-    try:
-        records = sheet.get_all_records()
-        
-        if message.text == '📊 Общая статистика':
-            # Статистика по статусам
-            status_stats = {}
-            total_cost = 0
-            completed_cost = 0
-            cost_values = []
-            
-            for r in records:
-                status = r.get('Статус', 'Нет статуса')
-                status_stats[status] = status_stats.get(status, 0) + 1
-                
-                # Считаем общую стоимость (берем 11-ю колонку, индексация с 0)
-                cost_str = str(r.get('Стоимость', '0')).strip()
-                if cost_str.isdigit():
-                    cost = int(cost_str)
-                    total_cost += cost
-                    cost_values.append(cost)
-                    if status == 'Готово':
-                        completed_cost += cost
-            
-            avg_cost = round(total_cost/len(records)) if len(records) > 0 else 0
-            if cost_values:
-                avg_cost = round(sum(cost_values)/len(cost_values))
-            
-            text = (
-                "📊 Общая статистика:\n"
-                f"Всего заявок: {len(records)}\n"
-                "\n📌 По статусам:\n"
-            )
-            text += '\n'.join(f"{k}: {v}" for k, v in sorted(status_stats.items()))
-            
-            text += (
-                f"\n\n💰 Общая стоимость всех заявок: {total_cost} руб.\n"
-                f"💰 Стоимость выполненных заявок: {completed_cost} руб.\n"
-                f"💵 Средняя стоимость заявки: {avg_cost} руб."
-            )
-            
-        elif message.text in ['📅 За текущий месяц', '📅 За прошлый месяц', '📆 За все время']:
-            now = datetime.now()
-            
-            if message.text == '📅 За текущий месяц':
-                month_records = [
-                    r for r in records 
-                    if parse_date(r.get('Дата', '')).month == now.month
-                    and parse_date(r.get('Дата', '')).year == now.year
-                ]
-                text = generate_monthly_report(month_records, now.month, now.year)
-                
-            elif message.text == '📅 За прошлый месяц':
-                last_month = now.month - 1 if now.month > 1 else 12
-                last_year = now.year if now.month > 1 else now.year - 1
-                month_records = [
-                    r for r in records 
-                    if parse_date(r.get('Дата', '')).month == last_month
-                    and parse_date(r.get('Дата', '')).year == last_year
-                ]
-                text = generate_monthly_report(month_records, last_month, last_year)
-                
-            elif message.text == '📆 За все время':
-                text = generate_full_report(records)
-                
-        else:
-            return
-            
-        bot.send_message(
-            message.chat.id,
-            text,
-            reply_markup=create_main_menu()
-        )
-        user_states.pop(message.chat.id, None)
-        
-    except Exception as e:
-        logger.error(f"Ошибка в handle_stat_period: {str(e)}", exc_info=True)
-        bot.send_message(
-            message.chat.id,
-            "Произошла ошибка при формировании отчета. Убедитесь, что данные в таблице корректны.",
-            reply_markup=create_main_menu()
-        )
-        user_states.pop(message.chat.id, None)
+# Отчёты: агрегаты по месяцам, закрытые месяцы кэшируются
+REPORT_CACHE_PATH = os.path.join(DATA_DIR, 'report_months.json')
+MONTH_NAMES = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
+               'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
+MONTH_SHORT_NAMES = ['Янв', 'Фев', 'Мар', 'Апр', 'Май', 'Июн',
+                     'Июл', 'Авг', 'Сен', 'Окт', 'Ноя', 'Дек']
 
 def parse_date(date_str):
     """Парсит дату из строки в объект datetime"""
@@ -832,133 +1850,420 @@ def parse_date(date_str):
     except:
         return datetime.min
 
-def generate_monthly_report(records, month, year):
-    """Генерация отчета за месяц"""
-    if not records:
-        month_names = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
-                     'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
-        return f"📅 За {month_names[month-1]} {year} нет данных"
-    
-    status_stats = {}
-    total_cost = 0
-    completed_cost = 0
-    cost_values = []
-    
+def month_key(date):
+    return f"{date.year}-{date.month:02d}"
+
+def record_id(record):
+    """Номер заявки из записи get_all_records (первая колонка)"""
+    value = str(next(iter(record.values()), '')).strip()
+    return int(value) if value.isdigit() else None
+
+def aggregate_records(records):
+    """Сводка по заявкам: количество, статусы, стоимость, диапазон номеров"""
+    stats = {
+        'count': 0, 'status': {}, 'total_cost': 0, 'completed_cost': 0,
+        'cost_count': 0, 'min_id': None, 'max_id': None
+    }
     for r in records:
+        stats['count'] += 1
         status = r.get('Статус', 'Нет статуса')
-        status_stats[status] = status_stats.get(status, 0) + 1
-        
+        stats['status'][status] = stats['status'].get(status, 0) + 1
+
         cost_str = str(r.get('Стоимость', '0')).strip()
         if cost_str.isdigit():
             cost = int(cost_str)
-            total_cost += cost
-            cost_values.append(cost)
+            stats['total_cost'] += cost
+            stats['cost_count'] += 1
             if status == 'Готово':
-                completed_cost += cost
-    
-    avg_cost = round(total_cost/len(records)) if len(records) > 0 else 0
-    if cost_values:
-        avg_cost = round(sum(cost_values)/len(cost_values))
-    
-    month_names = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
-                 'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
-    
-    completed = status_stats.get('Готово', 0)
-    completion_rate = round(completed/len(records)*100) if len(records) > 0 else 0
-    
+                stats['completed_cost'] += cost
+
+        aid = record_id(r)
+        if aid is not None:
+            stats['min_id'] = aid if stats['min_id'] is None else min(stats['min_id'], aid)
+            stats['max_id'] = aid if stats['max_id'] is None else max(stats['max_id'], aid)
+    return stats
+
+def merge_stats(stats_list):
+    merged = aggregate_records([])
+    for stats in stats_list:
+        for key in ('count', 'total_cost', 'completed_cost', 'cost_count'):
+            merged[key] += stats[key]
+        for status, count in stats['status'].items():
+            merged['status'][status] = merged['status'].get(status, 0) + count
+    return merged
+
+def records_fingerprint(records):
+    """Число записей и сумма их CRC32 — не зависит от порядка строк"""
+    digest = 0
+    for r in records:
+        digest = (digest + zlib.crc32('\x1f'.join(str(v) for v in r.values()).encode())) & 0xFFFFFFFF
+    return len(records), digest
+
+class MonthlyReportCache:
+    """Агрегаты по месяцам для /mystat.
+
+    Прошедшие месяцы считаются один раз и сохраняются на диск как
+    снимки; их записи при следующих отчётах не агрегируются заново, а
+    только сверяются по отпечатку (число строк и CRC в диапазоне номеров
+    заявок), так что правка прямо в таблице тоже пересчитывает месяц.
+    Если заявка прошлого месяца меняется через бота, снимок её месяца
+    сбрасывается сразу (invalidate). Ограничение: таблица для отчёта всё
+    равно читается целиком — кэш экономит разбор, а не чтение.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.closed = {}
+        self.ranges = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.closed = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша отчётов: {e}")
+        self.rebuild_ranges()
+
+    def rebuild_ranges(self):
+        self.ranges = sorted(
+            (s['min_id'], s['max_id'], key) for key, s in self.closed.items() if s['min_id'] is not None
+        )
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self.closed, f, ensure_ascii=False)
+            os.replace(self.path + '.tmp', self.path)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения кэша отчётов: {e}")
+
+    def cached_month(self, aid):
+        idx = bisect.bisect_right(self.ranges, (aid, float('inf'), '')) - 1
+        if idx >= 0 and self.ranges[idx][0] <= aid <= self.ranges[idx][1]:
+            return self.ranges[idx][2]
+        return None
+
+    def overlaps(self, stats):
+        return any(lo <= stats['max_id'] and stats['min_id'] <= hi for lo, hi, _ in self.ranges)
+
+    def months(self, records):
+        """Возвращает {'ГГГГ-ММ': агрегат} по всем месяцам"""
+        now_key = month_key(datetime.now())
+        with self.lock:
+            fresh = {}
+            cached = {}
+            for r in records:
+                aid = record_id(r)
+                key = self.cached_month(aid) if aid is not None else None
+                if key:
+                    cached.setdefault(key, []).append(r)
+                    continue
+                fresh.setdefault(month_key(parse_date(r.get('Дата', ''))), []).append(r)
+
+            changed = False
+            for key in list(self.closed):
+                month_records = cached.get(key, [])
+                snapshot = self.closed[key]
+                if records_fingerprint(month_records) != (snapshot.get('rows'), snapshot.get('digest')):
+                    # Строки месяца правили в обход бота — пересчитываем
+                    del self.closed[key]
+                    changed = True
+                    for r in month_records:
+                        fresh.setdefault(month_key(parse_date(r.get('Дата', ''))), []).append(r)
+            if changed:
+                self.rebuild_ranges()
+
+            result = dict(self.closed)
+            for key, month_records in fresh.items():
+                stats = aggregate_records(month_records)
+                result[key] = stats
+                # Снимок только для прошедшего месяца, у всех заявок которого есть номер
+                if (key < now_key and key not in self.closed and stats['min_id'] is not None
+                        and sum(1 for r in month_records if record_id(r) is None) == 0
+                        and not self.overlaps(stats)):
+                    rows, digest = records_fingerprint(month_records)
+                    self.closed[key] = dict(stats, rows=rows, digest=digest)
+                    self.rebuild_ranges()
+                    changed = True
+            if changed:
+                self.save()
+        return result
+
+    def invalidate(self, aid):
+        """Сбрасывает снимок месяца, к которому относится заявка"""
+        with self.lock:
+            key = self.cached_month(aid)
+            if key:
+                del self.closed[key]
+                self.rebuild_ranges()
+                self.save()
+
+report_cache = MonthlyReportCache(REPORT_CACHE_PATH)
+
+def stats_lines(stats):
+    return '\n'.join(f"{k}: {v}" for k, v in sorted(stats['status'].items()))
+
+def average_cost(stats):
+    return round(stats['total_cost'] / stats['cost_count']) if stats['cost_count'] else 0
+
+def completion_line(stats):
+    completed = stats['status'].get('Готово', 0)
+    completion_rate = round(completed / stats['count'] * 100) if stats['count'] > 0 else 0
+    return f"📈 Выполнено: {completed} из {stats['count']} ({completion_rate}%)"
+
+def generate_summary_report(stats):
+    """Общая статистика"""
     text = (
-        f"📅 Отчет за {month_names[month-1]} {year}:\n"
-        f"Всего заявок: {len(records)}\n"
+        "📊 Общая статистика:\n"
+        f"Всего заявок: {stats['count']}\n"
         "\n📌 По статусам:\n"
     )
-    text += '\n'.join(f"{k}: {v}" for k, v in sorted(status_stats.items()))
-    
+    text += stats_lines(stats)
     text += (
-        f"\n\n💰 Общая стоимость: {total_cost} руб.\n"
-        f"💰 Стоимость выполненных: {completed_cost} руб.\n"
-        f"💵 Средняя стоимость: {avg_cost} руб.\n"
-        f"📈 Выполнено: {completed} из {len(records)} ({completion_rate}%)"
+        f"\n\n💰 Общая стоимость всех заявок: {stats['total_cost']} руб.\n"
+        f"💰 Стоимость выполненных заявок: {stats['completed_cost']} руб.\n"
+        f"💵 Средняя стоимость заявки: {average_cost(stats)} руб."
+    )
+    return text
+
+def generate_monthly_report(stats, month, year):
+    """Генерация отчета за месяц"""
+    if not stats or not stats['count']:
+        return f"📅 За {MONTH_NAMES[month-1]} {year} нет данных"
+
+    text = (
+        f"📅 Отчет за {MONTH_NAMES[month-1]} {year}:\n"
+        f"Всего заявок: {stats['count']}\n"
+        "\n📌 По статусам:\n"
+    )
+    text += stats_lines(stats)
+    text += (
+        f"\n\n💰 Общая стоимость: {stats['total_cost']} руб.\n"
+        f"💰 Стоимость выполненных: {stats['completed_cost']} руб.\n"
+        f"💵 Средняя стоимость: {average_cost(stats)} руб.\n"
+        f"{completion_line(stats)}"
     )
-    
     return text
 
-def generate_full_report(records):
+def generate_full_report(months):
     """Генерация полного отчета за все время"""
-    if not records:
+    stats = merge_stats(months.values())
+    if not stats['count']:
         return "📆 Нет данных за все время"
-    
-    status_stats = {}
-    monthly_stats = {}
-    total_cost = 0
-    completed_cost = 0
-    cost_values = []
-    
-    for r in records:
-        status = r.get('Статус', 'Нет статуса')
-        status_stats[status] = status_stats.get(status, 0) + 1
-        
-        date = parse_date(r.get('Дата', ''))
-        month_key = f"{date.year}-{date.month:02d}"
-        monthly_stats[month_key] = monthly_stats.get(month_key, 0) + 1
-        
-        cost_str = str(r.get('Стоимость', '0')).strip()
-        if cost_str.isdigit():
-            cost = int(cost_str)
-            total_cost += cost
-            cost_values.append(cost)
-            if status == 'Готово':
-                completed_cost += cost
-    
-    avg_cost = round(total_cost/len(records)) if len(records) > 0 else 0
-    if cost_values:
-        avg_cost = round(sum(cost_values)/len(cost_values))
-    
-    completed = status_stats.get('Готово', 0)
-    completion_rate = round(completed/len(records)*100) if len(records) > 0 else 0
-    
+
     text = (
         "📆 Полная статистика:\n"
-        f"Всего заявок: {len(records)}\n"
+        f"Всего заявок: {stats['count']}\n"
         "\n📌 По статусам:\n"
     )
-    text += '\n'.join(f"{k}: {v}" for k, v in sorted(status_stats.items()))
-    
+    text += stats_lines(stats)
+
     text += "\n\n📅 По месяцам:\n"
-    for month in sorted(monthly_stats.keys()):
-        year, month_num = map(int, month.split('-'))
-        month_names = ['Янв', 'Фев', 'Мар', 'Апр', 'Май', 'Июн',
-                      'Июл', 'Авг', 'Сен', 'Окт', 'Ноя', 'Дек']
-        text += f"{month_names[month_num-1]} {year}: {monthly_stats[month]}\n"
-    
+    for key in sorted(months):
+        if not months[key]['count']:
+            continue
+        year, month_num = map(int, key.split('-'))
+        text += f"{MONTH_SHORT_NAMES[month_num-1]} {year}: {months[key]['count']}\n"
+
     text += (
-        f"\n💰 Общая стоимость: {total_cost} руб.\n"
-        f"💰 Стоимость выполненных: {completed_cost} руб.\n"
-        f"💵 Средняя стоимость: {avg_cost} руб.\n"
-        f"📈 Выполнено: {completed} из {len(records)} ({completion_rate}%)"
+        f"\n💰 Общая стоимость: {stats['total_cost']} руб.\n"
+        f"💰 Стоимость выполненных: {stats['completed_cost']} руб.\n"
+        f"💵 Средняя стоимость: {average_cost(stats)} руб.\n"
+        f"{completion_line(stats)}"
     )
-    
     return text
 
-@bot.message_handler(commands=['money'])
-def set_money(message):
+# Графики для /mystat
+DASHBOARD_MONTHS = 12
+STATUS_COLORS = {
+    'Новая': '#f4c542', 'Принято': '#f4a742', 'В работе': '#f47c42',
+    'Готово': '#4caf50', 'Выдано': '#2e7d32', 'Отклонено': '#e53935'
+}
+
+def load_chart_font(size):
+    for name in ('DejaVuSans.ttf', 'Arial.ttf'):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+def draw_bar_chart(draw, box, title, labels, values, color, font, small_font):
+    left, top, right, bottom = box
+    draw.text((left, top), title, font=font, fill='black')
+    top += 40
+    chart_bottom = bottom - 30
+    max_value = max(values) if values and max(values) > 0 else 1
+    slot = (right - left) / max(len(values), 1)
+    draw.line((left, chart_bottom, right, chart_bottom), fill='#999999', width=1)
+    for i, (label, value) in enumerate(zip(labels, values)):
+        x0 = left + i * slot + slot * 0.15
+        x1 = left + (i + 1) * slot - slot * 0.15
+        y0 = chart_bottom - (chart_bottom - top - 20) * value / max_value
+        draw.rectangle((x0, y0, x1, chart_bottom), fill=color)
+        draw.text((x0, y0 - 18), str(value), font=small_font, fill='black')
+        draw.text((x0, chart_bottom + 5), label, font=small_font, fill='#444444')
+
+def render_dashboard(months):
+    """PNG с графиками: заявки и выручка по месяцам, статусы за всё время"""
+    stats = merge_stats(months.values())
+    width, height = 1200, 1000 + 40 * len(stats['status'])
+    img = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(img)
+    font = load_chart_font(26)
+    small_font = load_chart_font(16)
+
+    now = datetime.now()
+    keys = []
+    year, month = now.year, now.month
+    for _ in range(DASHBOARD_MONTHS):
+        keys.append(f"{year}-{month:02d}")
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    keys.reverse()
+    labels = [f"{MONTH_SHORT_NAMES[int(k[5:]) - 1]} {k[2:4]}" for k in keys]
+    counts = [months[k]['count'] if k in months else 0 for k in keys]
+    revenue = [months[k]['total_cost'] if k in months else 0 for k in keys]
+
+    draw_bar_chart(draw, (40, 30, width - 40, 430), 'Заявки по месяцам', labels, counts, '#4a90d9', font, small_font)
+    draw_bar_chart(draw, (40, 470, width - 40, 870), 'Выручка по месяцам, руб.', labels, revenue, '#4caf50', font, small_font)
+
+    draw.text((40, 910), f"Статусы за всё время (всего {stats['count']})", font=font, fill='black')
+    y = 960
+    max_count = max(stats['status'].values()) if stats['status'] else 1
+    for status, count in sorted(stats['status'].items(), key=lambda i: -i[1]):
+        bar = (width - 400) * count / max_count
+        draw.text((40, y + 4), str(status), font=small_font, fill='black')
+        draw.rectangle((220, y, 220 + bar, y + 28), fill=STATUS_COLORS.get(status, '#9e9e9e'))
+        draw.text((230 + bar, y + 4), str(count), font=small_font, fill='black')
+        y += 40
+
+    output = BytesIO()
+    img.save(output, format='PNG')
+    output.seek(0)
+    return output
+
+@bot.message_handler(commands=['mystat'])
+def mystat(message):
     if message.from_user.id != MASTER_ID: 
         return
     
     try:
-        parts = message.text.split()
-        if len(parts) < 3: 
-            return bot.send_message(message.chat.id, 'Используйте: /money [ID] [стоимость]')
+        # Создаем клавиатуру для выбора периода
+        kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+        kb.row('📊 Общая статистика', '📈 Графики')
+        kb.row('📅 За текущий месяц', '📅 За прошлый месяц')
+        kb.row('📆 За все время', '🔙 Назад')
         
-        aid = int(parts[1])
-        cost = parts[2]
+        bot.send_message(
+            message.chat.id,
+            "Выберите период для статистики:",
+            reply_markup=kb
+        )
+        user_states[message.chat.id] = 'stat_period'
+    except Exception as e:
+        logger.error(f"Ошибка в mystat: {e}")
+        bot.send_message(message.chat.id, "Не удалось загрузить статистику", reply_markup=create_main_menu())
+
+def report_months():
+    """Агрегаты по месяцам: рабочий лист через кэш плюс готовые итоги архива"""
+    months = report_cache.months(sheet.get_all_records())
+    for key, stats in archive_store.month_stats().items():
+        months[key] = merge_stats([months[key], stats]) if key in months else stats
+    return months
+
+@bot.message_handler(func=lambda m: user_states.get(m.chat.id) == 'stat_period')
+def handle_stat_period(message):
+    if message.text == '🔙 Назад':
+        bot.send_message(message.chat.id, "Возвращаемся в главное меню", reply_markup=create_main_menu())
+        user_states.pop(message.chat.id, None)
+        return
+    
+    try:
+        if message.text not in ['📊 Общая статистика', '📈 Графики', '📅 За текущий месяц',
+                                '📅 За прошлый месяц', '📆 За все время']:
+            return
+
+        if check_flood(message):
+            user_states.pop(message.chat.id, None)
+            return
+        months = report_months()
+        now = datetime.now()
+
+        if message.text == '📈 Графики':
+            bot.send_photo(message.chat.id, render_dashboard(months), reply_markup=create_main_menu())
+            user_states.pop(message.chat.id, None)
+            return
+
+        if message.text == '📊 Общая статистика':
+            text = generate_summary_report(merge_stats(months.values()))
+        elif message.text == '📅 За текущий месяц':
+            text = generate_monthly_report(months.get(month_key(now)), now.month, now.year)
+        elif message.text == '📅 За прошлый месяц':
+            last_month = now.month - 1 if now.month > 1 else 12
+            last_year = now.year if now.month > 1 else now.year - 1
+            text = generate_monthly_report(months.get(f"{last_year}-{last_month:02d}"), last_month, last_year)
+        else:
+            text = generate_full_report(months)
+            
+        bot.send_message(
+            message.chat.id,
+            text,
+            reply_markup=create_main_menu()
+        )
+        user_states.pop(message.chat.id, None)
         
+    except SheetsBusy:
+        bot.send_message(message.chat.id, BUSY_TEXT, reply_markup=create_main_menu())
+        user_states.pop(message.chat.id, None)
+    except Exception as e:
+        logger.error(f"Ошибка в handle_stat_period: {str(e)}", exc_info=True)
+        bot.send_message(
+            message.chat.id,
+            "Произошла ошибка при формировании отчета. Убедитесь, что данные в таблице корректны.",
+            reply_markup=create_main_menu()
+        )
+        user_states.pop(message.chat.id, None)
+
+@bot.message_handler(commands=['money'])
+@stable_rows
+def set_money(message):
+    if message.from_user.id != MASTER_ID: 
+        return
+    
+    try:
+        parts = message.text.split()[1:]
+        if len(parts) == 2 and ':' not in parts[0]:
+            parts = [f"{parts[0]}:{parts[1]}"]
+        if not parts or any(':' not in p for p in parts):
+            return bot.send_message(message.chat.id, 'Используйте: /money [ID] [стоимость] или /money 12:1500 13:2000')
+
+        costs = {}
+        for part in parts:
+            aid, cost = part.split(':', 1)
+            costs[int(aid)] = cost
+        if len(costs) > BULK_MAX_IDS:
+            return bot.send_message(message.chat.id, f'Не больше {BULK_MAX_IDS} заявок за раз')
+
         try:
-            cell = sheet.find(str(aid))
-            row = cell.row
-            sheet.update_cell(row, 11, cost)
-            bot.send_message(message.chat.id, f"Стоимость #{aid} установлена: {cost}")
-        except:
-            bot.send_message(message.chat.id, f"Заявка #{aid} не найдена")
+            rows, _ = resolve_rows(list(costs))
+            if rows:
+                update_cells(rows, COST_COLUMN, costs)
+            for aid in rows:
+                report_cache.invalidate(aid)
+        except SheetsBusy:
+            return bot.send_message(message.chat.id, BUSY_TEXT)
+
+        missing = [aid for aid in costs if aid not in rows]
+        if len(costs) == 1:
+            aid, cost = next(iter(costs.items()))
+            text = f"Стоимость #{aid} установлена: {cost}" if rows else f"Заявка #{aid} не найдена"
+        else:
+            text = "💰 Стоимость установлена:\n" + '\n'.join(f"#{aid}: {costs[aid]}" for aid in rows)
+            if missing:
+                text += f"\n⚠️ Не найдены: {format_ids(missing)}"
+        bot.send_message(message.chat.id, text)
             
     except ValueError:
         bot.send_message(message.chat.id, 'ID должен быть числом')
@@ -966,20 +2271,948 @@ def set_money(message):
         logger.error(f"Ошибка в set_money: {e}")
         bot.send_message(message.chat.id, "Произошла ошибка")
 
+# Поиск заявок для мастера: /find <текст>
+SEARCH_FIELDS = {'name': 2.0, 'phone': 3.0, 'device_type': 1.5, 'device_model': 2.0, 'problem': 1.0}
+SEARCH_RESULTS_LIMIT = 10
+# Догрузка берёт хвост листа с запасом в SEARCH_TAIL_OVERLAP строк; номер, выданный,
+# но ещё не записанный в таблицу, перепроверяется не дольше SEARCH_PENDING_SECONDS
+SEARCH_TAIL_OVERLAP = 50
+SEARCH_PENDING_SECONDS = 120
+# Правки, сделанные прямо в таблице, подхватывает полная сверка в фоне не реже этого
+SEARCH_RESYNC_SECONDS = int(os.getenv('SEARCH_RESYNC_SECONDS', '600'))
+
+def normalize_text(text):
+    return str(text or '').lower().replace('ё', 'е')
+
+def search_words(field, text):
+    text = normalize_text(text)
+    if field == 'phone':
+        digits = re.sub(r'\D', '', text)
+        return [digits] if digits else []
+    return re.findall(r'\w+', text)
+
+def search_terms(word):
+    """Ключи индекса для слова: триграммы, для коротких слов — само слово"""
+    if len(word) < 3:
+        return {'w:' + word}
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+class SearchIndex:
+    """Инвертированный триграммный индекс заявок в памяти.
+
+    Индексируются имя, телефон, тип и модель устройства и описание
+    неисправности. Индекс строится из таблицы при первом поиске и дальше
+    обновляется при создании заявок и смене статуса. Заявки других
+    процессов догружаются из хвоста листа, когда растёт общий счётчик номеров.
+    Ручные правки в таблице попадают в индекс при фоновой сверке: её
+    запускает поиск, если индекс восстановлен из снимка или сверялся
+    дольше SEARCH_RESYNC_SECONDS назад, — до её окончания поиск отвечает
+    по прежнему индексу.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.docs = {}
+        self.postings = {}
+        self.max_id = 0
+        self.built = False
+        self.seen_id = 0     # значение счётчика номеров при последней сверке
+        self.sheet_rows = 0  # число строк рабочего листа при последней сверке
+        self.pending = {}    # выданные, но ещё не найденные номера: {aid: когда замечен}
+        self.synced_at = 0   # time.monotonic() последней полной сверки
+        self.resyncing = False
+        self.removed = 0     # всего строк, удалённых архиватором
+        self.touched = set() # заявки, изменённые ботом во время сверки
+
+    def add(self, aid, doc):
+        with self.lock:
+            self.remove(aid)
+            doc = dict(doc)
+            doc['words'] = {field: search_words(field, doc.get(field)) for field in SEARCH_FIELDS}
+            self.docs[aid] = doc
+            self.touched.add(aid)
+            for words in doc['words'].values():
+                for word in words:
+                    for term in search_terms(word):
+                        self.postings.setdefault(term, set()).add(aid)
+            self.max_id = max(self.max_id, aid)
+
+    def remove(self, aid):
+        with self.lock:
+            doc = self.docs.pop(aid, None)
+            if not doc:
+                return
+            for words in doc['words'].values():
+                for word in words:
+                    for term in search_terms(word):
+                        postings = self.postings.get(term)
+                        if postings:
+                            postings.discard(aid)
+
+    def update_status(self, aid, status):
+        with self.lock:
+            if aid in self.docs:
+                self.docs[aid]['status'] = status
+                self.touched.add(aid)
+
+    def add_row(self, row):
+        """Добавляет строку таблицы, возвращает номер заявки или None"""
+        row = row + [''] * (10 - len(row))
+        if not row[0].strip().isdigit():
+            return None
+        aid = int(row[0])
+        self.add(aid, {
+            'date': row[1], 'name': row[2], 'phone': row[3], 'device_type': row[4],
+            'device_model': row[5], 'problem': row[6], 'status': row[9]
+        })
+        return aid
+
+    def load_rows(self, rows):
+        """Полная загрузка из строк таблицы (get_all_values)"""
+        with self.lock:
+            self.docs = {}
+            self.postings = {}
+            self.max_id = 0
+            for row in rows[1:]:
+                self.add_row(row)
+            self.built = True
+            self.synced_at = time.monotonic()
+
+    def rows_removed(self, count):
+        """Архиватор удалил строки из рабочего листа — хвост сдвинулся вверх"""
+        with self.lock:
+            self.sheet_rows = max(0, self.sheet_rows - count)
+            self.removed += count
+
+    def resync(self):
+        """Полная сверка с листом в фоновом потоке: новый индекс строится отдельно и подменяет старый"""
+        try:
+            with self.lock:
+                self.touched = set()
+            # Под sheet_rows_lock архиватор не удаляет строки, пока читаем лист
+            with sheets_priority(PRIORITY_STATS), sheet_rows_lock:
+                values = sheet.get_all_values()
+                removed = self.removed
+            fresh = SearchIndex()
+            fresh.load_rows(values + archive_store.rows())
+            with self.lock:
+                # Изменения бота во время чтения могли не попасть в прочитанный лист
+                for aid in self.touched:
+                    if aid in self.docs:
+                        fresh.add(aid, {k: v for k, v in self.docs[aid].items() if k != 'words'})
+                self.docs, self.postings, self.max_id = fresh.docs, fresh.postings, fresh.max_id
+                self.sheet_rows = max(0, len(values) - (self.removed - removed))
+                self.synced_at = time.monotonic()
+        except SheetsBusy:
+            logger.info("Search index resync postponed: Sheets quota is busy")
+        except Exception as e:
+            logger.error(f"Ошибка сверки поискового индекса: {e}")
+        finally:
+            self.resyncing = False
+
+    def refresh(self):
+        """Догружает заявки, созданные другими процессами бота"""
+        with self.lock:
+            current = shared_store.current_id()
+            now = time.time()
+            self.pending = {aid: t for aid, t in self.pending.items() if now - t < SEARCH_PENDING_SECONDS}
+            if not self.built:
+                values = sheet.get_all_values()
+                self.load_rows(values + archive_store.rows())
+                self.sheet_rows = len(values)
+            else:
+                # Заявки этого процесса уже добавлены через add — лист читаем только ради чужих
+                for aid in range(self.seen_id + 1, current + 1):
+                    if aid not in self.docs:
+                        self.pending[aid] = now
+                if self.pending:
+                    start = max(2, self.sheet_rows + 1 - SEARCH_TAIL_OVERLAP)
+                    tail = sheet.get(f"A{start}:M")
+                    for row in tail:
+                        self.pending.pop(self.add_row(row), None)
+                    self.sheet_rows = start - 1 + len(tail)
+                if time.monotonic() - self.synced_at > SEARCH_RESYNC_SECONDS and not self.resyncing:
+                    self.resyncing = True
+                    threading.Thread(target=self.resync, name='search-resync', daemon=True).start()
+            self.seen_id = current
+
+    def search(self, query, limit=SEARCH_RESULTS_LIMIT):
+        """Возвращает [(aid, doc)] по убыванию релевантности, затем по новизне"""
+        tokens = []
+        for word in re.findall(r'[\w+]+', normalize_text(query)):
+            digits = re.sub(r'\D', '', word)
+            tokens.append(digits if len(digits) >= 4 else word.strip('+'))
+        scores = {}
+        with self.lock:
+            for token in filter(None, tokens):
+                postings = sorted((self.postings.get(t, set()) for t in search_terms(token)), key=len)
+                candidates = set.intersection(*postings) if postings else set()
+                for aid in candidates:
+                    score = self.score(self.docs[aid], token)
+                    if score:
+                        scores[aid] = scores.get(aid, 0) + score
+            ranked = sorted(scores, key=lambda aid: (-scores[aid], -aid))[:limit]
+            return [(aid, self.docs[aid]) for aid in ranked]
+
+    @staticmethod
+    def score(doc, token):
+        best = 0
+        for field, weight in SEARCH_FIELDS.items():
+            for word in doc['words'][field]:
+                if word == token:
+                    best = max(best, 3 * weight)
+                elif word.startswith(token):
+                    best = max(best, 2 * weight)
+                elif token in word:
+                    best = max(best, weight)
+        return best
+
+    def dump(self):
+        with self.lock:
+            if not self.built:
+                return None
+            return {
+                'docs': [[aid, {k: v for k, v in doc.items() if k != 'words'}] for aid, doc in self.docs.items()],
+                'seen_id': self.seen_id,
+                'sheet_rows': self.sheet_rows
+            }
+
+    def load(self, data):
+        if not isinstance(data, dict):
+            return
+        with self.lock:
+            for aid, doc in data['docs']:
+                self.add(aid, doc)
+            self.seen_id = data['seen_id']
+            self.sheet_rows = data['sheet_rows']
+            self.built = True
+            # Пока процесс был остановлен, таблицу могли править вручную
+            self.synced_at = 0
+
+search_index = SearchIndex()
+register_snapshot(
+    'search_index', search_index.dump, search_index.load,
+    lambda a, b: a if a['seen_id'] >= b['seen_id'] else b
+)
+
+@bot.message_handler(commands=['find'])
+def find_applications(message):
+    if message.from_user.id != MASTER_ID:
+        return
+
+    try:
+        parts = message.text.split(maxsplit=1)
+        if len(parts) < 2 or not parts[1].strip():
+            return bot.send_message(message.chat.id, 'Используйте: /find [имя, телефон, устройство или проблема]')
+
+        if check_flood(message):
+            return
+        search_index.refresh()
+        results = search_index.search(parts[1])
+        if not results:
+            return bot.send_message(message.chat.id, 'Ничего не найдено')
+
+        text = f"🔎 Найдено: {len(results)}\n"
+        for aid, doc in results:
+            text += (
+                f"\n#{aid} · {doc['date'].split(' ')[0]} · {doc['status']}\n"
+                f"👤 {doc['name']} · 📞 {doc['phone']}\n"
+                f"🔌 {doc['device_type']} {doc['device_model']} · ⚙️ {doc['problem']}\n"
+            )
+        bot.send_message(message.chat.id, text[:4000])
+    except SheetsBusy:
+        bot.send_message(message.chat.id, BUSY_TEXT)
+    except Exception as e:
+        logger.error(f"Ошибка в find_applications: {e}")
+        bot.send_message(message.chat.id, "Произошла ошибка")
+
+# SLA: напоминания мастеру о зависших заявках
+SLA_RULES = {
+    'Новая': float(os.getenv('SLA_NEW_HOURS', '24')),
+    'Принято': float(os.getenv('SLA_DIAGNOSTICS_HOURS', '72')),  # «Срок диагностики: 1-3 дня»
+    'В работе': float(os.getenv('SLA_IN_WORK_HOURS', '168')),
+}
+SLA_DIGEST_HOUR = int(os.getenv('SLA_DIGEST_HOUR', '9'))
+SLA_POLL_SECONDS = 30
+SLA_DIGEST_LIMIT = 30
+
+def sla_track(aid, status, since=None):
+    """Отмечает смену статуса заявки; вызывается при создании и каждом изменении"""
+    try:
+        shared_store.sla_set(aid, status, since or time.time())
+        sla_scheduler.wakeup.set()
+    except Exception as e:
+        logger.error(f"Ошибка SLA для заявки #{aid}: {e}")
+
+class SlaScheduler:
+    """Куча дедлайнов заявок в отдельном потоке.
+
+    Дедлайн — время входа в статус плюс SLA_RULES[статус]. Изменения статусов
+    приходят через таблицу sla общего хранилища (их пишут все процессы),
+    таблица Google при запуске читается один раз. Просроченная заявка
+    вызывает одно уведомление мастеру, раз в день отправляется сводка.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.heap = []
+        self.entries = {}
+        self.last_seq = 0
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.next_digest = self.digest_time_after(datetime.now())
+
+    @staticmethod
+    def digest_time_after(now):
+        digest = now.replace(hour=SLA_DIGEST_HOUR, minute=0, second=0, microsecond=0)
+        if digest <= now:
+            digest += timedelta(days=1)
+        return digest.timestamp()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='sla', daemon=True)
+        self.thread.start()
+
+    def sync_with_sheet(self):
+        """Добавляет заявки, статус которых ещё не известен SLA (первый запуск, ручные правки)"""
+        known = {aid: status for aid, status, *_ in self.store.sla_changes(0)}
+        for row in sheet.get_all_values()[1:]:
+            row = row + [''] * (10 - len(row))
+            if not row[0].strip().isdigit():
+                continue
+            aid, status = int(row[0]), row[9]
+            if known.get(aid) == status or (aid not in known and status not in SLA_RULES):
+                continue
+            created = parse_date(row[1])
+            since = created.timestamp() if created != datetime.min else time.time()
+            # Давно просроченные заявки попадут в сводку, а не в поток отдельных уведомлений
+            overdue = status in SLA_RULES and since + SLA_RULES[status] * 3600 <= time.time()
+            self.store.sla_set(aid, status, since, alerted=overdue)
+
+    def consume_changes(self):
+        for aid, status, since, alerted, seq in self.store.sla_changes(self.last_seq):
+            self.last_seq = seq
+            if status not in SLA_RULES:
+                self.entries.pop(aid, None)
+                continue
+            deadline = since + SLA_RULES[status] * 3600
+            self.entries[aid] = {'status': status, 'since': since, 'deadline': deadline, 'alerted': bool(alerted)}
+            if not alerted:
+                heapq.heappush(self.heap, (deadline, aid))
+
+    def fire_due(self):
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, aid = heapq.heappop(self.heap)
+            entry = self.entries.get(aid)
+            if not entry or entry['deadline'] != deadline or entry['alerted']:
+                continue
+            self.alert(aid, entry)
+            entry['alerted'] = True
+            self.store.sla_mark_alerted(aid)
+
+    def alert(self, aid, entry):
+        hours = SLA_RULES[entry['status']]
+        text = f"⏰ Заявка #{aid} в статусе «{entry['status']}» дольше {hours:g} ч"
+        if entry['status'] == 'Принято':
+            text += "\nСрок диагностики истёк"
+        text += f"\nС {datetime.fromtimestamp(entry['since']).strftime('%d.%m %H:%M')}. /setstatus {aid}"
+        bot.send_message(MASTER_ID, text)
+
+    def digest_text(self):
+        now = time.time()
+        overdue = sorted((e['deadline'], aid) for aid, e in self.entries.items() if e['deadline'] <= now)
+        soon = sorted((e['deadline'], aid) for aid, e in self.entries.items() if now < e['deadline'] <= now + 86400)
+        text = f"📋 Сводка на {datetime.now().strftime('%d.%m')}\n"
+        text += f"\n⏰ Просрочено: {len(overdue)}\n"
+        for deadline, aid in overdue[:SLA_DIGEST_LIMIT]:
+            entry = self.entries[aid]
+            days = (now - entry['since']) / 86400
+            text += f"#{aid} {entry['status']} — {days:.1f} дн.\n"
+        text += f"\n🕐 Истекает в ближайшие сутки: {len(soon)}\n"
+        for deadline, aid in soon[:SLA_DIGEST_LIMIT]:
+            text += f"#{aid} {self.entries[aid]['status']} — до {datetime.fromtimestamp(deadline).strftime('%d.%m %H:%M')}\n"
+        return text
+
+    def run(self):
+        synced = False
+        while not shutdown_event.is_set():
+            try:
+                if not synced:
+                    self.sync_with_sheet()
+                    synced = True
+            except SheetsBusy:
+                pass  # квота занята — повторим на следующем круге
+            except Exception as e:
+                logger.error(f"SLA: не удалось сверить статусы с таблицей: {e}")
+                synced = True
+            try:
+                self.consume_changes()
+                self.fire_due()
+                if time.time() >= self.next_digest:
+                    self.next_digest = self.digest_time_after(datetime.now())
+                    bot.send_message(MASTER_ID, self.digest_text())
+            except Exception as e:
+                logger.error(f"Ошибка в SLA-планировщике: {e}")
+            timeout = min(SLA_POLL_SECONDS, self.next_digest - time.time())
+            if self.heap:
+                timeout = min(timeout, self.heap[0][0] - time.time())
+            self.wakeup.wait(max(timeout, 0.1))
+            self.wakeup.clear()
+
+sla_scheduler = SlaScheduler(shared_store)
+
+# Архив: старые завершённые заявки переносятся из рабочего листа в листы
+# «Архив ГГГГ», чтобы find/get_all_values не читали всю историю мастерской
+ARCHIVE_DB_PATH = os.path.join(DATA_DIR, 'archive.db')
+ARCHIVE_STATUSES = ('Выдано', 'Отклонено')
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_INTERVAL_HOURS = float(os.getenv('ARCHIVE_INTERVAL_HOURS', '24'))
+
+class ArchiveStore:
+    """Локальный индекс архива: сжатая копия строки заявки и её место в архивном листе.
+
+    Проверка статуса и поиск читают архивные заявки отсюда, не обращаясь
+    к Google Sheets, отчёты — готовые помесячные итоги (таблица months).
+    Заявка попадает в итоги, только когда её строка удалена из рабочего
+    листа (count_months), иначе отчёт посчитал бы её дважды. Основная
+    копия остаётся в листах «Архив ГГГГ».
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS rows (aid INTEGER PRIMARY KEY, title TEXT NOT NULL, '
+            'row INTEGER NOT NULL, data BLOB NOT NULL, counted INTEGER NOT NULL DEFAULT 0)'
+        )
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS months (key TEXT PRIMARY KEY, stats TEXT NOT NULL)')
+        # Архив, созданный до появления итогов: его заявки учтёт следующий проход архиватора
+        columns = [c[1] for c in self.conn.execute('PRAGMA table_info(rows)')]
+        if 'counted' not in columns:
+            self.conn.execute('ALTER TABLE rows ADD COLUMN counted INTEGER NOT NULL DEFAULT 0')
+
+    @staticmethod
+    def pack(values):
+        return zlib.compress(json.dumps(values, ensure_ascii=False).encode('utf-8'))
+
+    @staticmethod
+    def unpack(data):
+        return json.loads(zlib.decompress(data).decode('utf-8'))
+
+    def add(self, header, entries):
+        """Запоминает перенесённые строки: entries — [(aid, лист, номер строки, значения)]"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('header', json.dumps(header)))
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO rows (aid, title, row, data) VALUES (?, ?, ?, ?)',
+                    [(aid, title, row, self.pack(values)) for aid, title, row, values in entries]
+                )
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def get(self, aid):
+        """Значения строки архивной заявки или None"""
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM rows WHERE aid = ?', (aid,)).fetchone()
+        return self.unpack(row[0]) if row else None
+
+    def archived_ids(self):
+        with self.lock:
+            return {aid for aid, in self.conn.execute('SELECT aid FROM rows')}
+
+    def max_id(self):
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(MAX(aid), 0) FROM rows').fetchone()[0]
+
+    def rows(self):
+        """Строки в формате get_all_values (без заголовка), по возрастанию номера"""
+        with self.lock:
+            data = self.conn.execute('SELECT data FROM rows ORDER BY aid').fetchall()
+        return [self.unpack(d) for d, in data]
+
+    def uncounted_ids(self):
+        with self.lock:
+            return [aid for aid, in self.conn.execute('SELECT aid FROM rows WHERE counted = 0')]
+
+    def count_months(self, aids):
+        """Добавляет заявки, удалённые из рабочего листа, в помесячные итоги архива"""
+        aids = set(aids)
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                header = json.loads(self.conn.execute("SELECT value FROM meta WHERE name = 'header'").fetchone()[0])
+                by_month = {}
+                counted = []
+                for aid, data in self.conn.execute('SELECT aid, data FROM rows WHERE counted = 0').fetchall():
+                    if aid not in aids:
+                        continue
+                    record = {h: v for h, v in zip(header, self.unpack(data)) if h}
+                    by_month.setdefault(month_key(parse_date(record.get('Дата', ''))), []).append(record)
+                    counted.append((aid,))
+                for key, records in by_month.items():
+                    stats = aggregate_records(records)
+                    row = self.conn.execute('SELECT stats FROM months WHERE key = ?', (key,)).fetchone()
+                    if row:
+                        stats = merge_stats([json.loads(row[0]), stats])
+                    self.conn.execute('INSERT OR REPLACE INTO months VALUES (?, ?)', (key, json.dumps(stats)))
+                self.conn.executemany('UPDATE rows SET counted = 1 WHERE aid = ?', counted)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def month_stats(self):
+        """Помесячные итоги архивных заявок: {'ГГГГ-ММ': агрегат}"""
+        with self.lock:
+            return {key: json.loads(stats) for key, stats in self.conn.execute('SELECT key, stats FROM months')}
+
+archive_store = ArchiveStore(ARCHIVE_DB_PATH)
+
+def row_ranges(numbers):
+    """Сжимает номера строк в непрерывные диапазоны [(начало, конец)]"""
+    ranges = []
+    for number in sorted(numbers):
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return [tuple(r) for r in ranges]
+
+class Archiver:
+    """Раз в ARCHIVE_INTERVAL_HOURS переносит заявки в статусах ARCHIVE_STATUSES,
+    созданные больше ARCHIVE_AFTER_DAYS дней назад, в листы «Архив ГГГГ».
+
+    Порядок: дописать строки в архивный лист, сохранить их в ArchiveStore,
+    затем удалить из рабочего листа и учесть в итогах архива. После сбоя на
+    любом шаге повторный запуск не создаёт дублей: уже сохранённые заявки
+    только удаляются и учитываются. Весь проход идёт под sheet_rows_lock,
+    чтобы мастер не изменил строку между копированием и удалением.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.sheets = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='archiver', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not shutdown_event.is_set():
+            delay = ARCHIVE_INTERVAL_HOURS * 3600
+            try:
+                self.archive()
+            except SheetsBusy:
+                delay = 600  # квота занята клиентами — попробуем позже
+            except Exception as e:
+                logger.error(f"Ошибка архивации заявок: {e}")
+            shutdown_event.wait(delay)
+
+    def worksheet(self, year, header):
+        """Лист «Архив ГГГГ»; создаётся с заголовком рабочего листа при первом переносе"""
+        title = f"Архив {year}"
+        if title not in self.sheets:
+            try:
+                ws = sheets_governor.call(PRIORITY_STATUS, spreadsheet.worksheet, title)
+            except gspread.exceptions.WorksheetNotFound:
+                ws = sheets_governor.call(PRIORITY_WRITE, spreadsheet.add_worksheet, title, 1, len(header))
+                sheets_governor.call(PRIORITY_WRITE, ws.append_row, header)
+            self.sheets[title] = GovernedWorksheet(ws, sheets_governor)
+        return self.sheets[title]
+
+    def request(self, chat_id):
+        """Запуск по команде мастера — в отдельном потоке, чтобы не занимать поток опроса"""
+        def job():
+            try:
+                bot.send_message(chat_id, f"🗄 Перенесено в архив: {self.archive()}")
+            except SheetsBusy:
+                bot.send_message(chat_id, BUSY_TEXT)
+            except Exception as e:
+                logger.error(f"Ошибка архивации по команде: {e}")
+                bot.send_message(chat_id, "Произошла ошибка")
+
+        threading.Thread(target=job, name='archive-request', daemon=True).start()
+
+    def archive(self):
+        """Переносит подходящие заявки, возвращает их количество"""
+        with self.lock, sheet_rows_lock:
+            cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+            values = sheet.get_all_values()
+            # Заявки, удалённые прошлым проходом, но не учтённые в итогах (сбой между шагами)
+            hot_ids = {row[0].strip() for row in values[1:] if row}
+            lost = [aid for aid in self.store.uncounted_ids() if str(aid) not in hot_ids]
+            if lost:
+                self.store.count_months(lost)
+            if len(values) < 2:
+                return 0
+            header = values[0]
+            due = {}
+            for number, row in enumerate(values[1:], start=2):
+                padded = row + [''] * (10 - len(row))
+                created = parse_date(padded[1])
+                if (padded[0].strip().isdigit() and padded[9] in ARCHIVE_STATUSES
+                        and datetime.min < created < cutoff):
+                    due[number] = (int(padded[0]), created.year, row)
+            if not due:
+                return 0
+
+            archived = self.store.archived_ids()
+            by_year = {}
+            for aid, year, row in due.values():
+                if aid not in archived:
+                    by_year.setdefault(year, []).append((aid, row))
+            for year, items in sorted(by_year.items()):
+                ws = self.worksheet(year, header)
+                response = ws.append_rows([row for _, row in items])
+                first = int(re.search(r'![A-Z]+(\d+)', response['updates']['updatedRange']).group(1))
+                self.store.add(header, [(aid, ws.title, first + i, row) for i, (aid, row) in enumerate(items)])
+
+            # Сверяем номера строк перед удалением: лист могли отредактировать вручную
+            ids = sheet.col_values(1)
+            numbers = [
+                number for number, (aid, _, _) in due.items()
+                if number <= len(ids) and ids[number - 1].strip() == str(aid)
+            ]
+            # Все диапазоны — одним запросом, снизу вверх, чтобы номера не сдвигались
+            deletions = [
+                {'deleteDimension': {'range': {
+                    'sheetId': sheet.id, 'dimension': 'ROWS', 'startIndex': start - 1, 'endIndex': end
+                }}}
+                for start, end in reversed(row_ranges(numbers))
+            ]
+            if deletions:
+                sheets_governor.call(PRIORITY_WRITE, spreadsheet.batch_update, {'requests': deletions})
+                search_index.rows_removed(len(numbers))
+                self.store.count_months(due[number][0] for number in numbers)
+            logger.info(f"В архив перенесено заявок: {len(numbers)}")
+            return len(numbers)
+
+archiver = Archiver(archive_store)
+
+@bot.message_handler(commands=['archive'])
+def run_archive(message):
+    if message.from_user.id != MASTER_ID:
+        return
+    try:
+        archiver.request(message.chat.id)
+        bot.send_message(message.chat.id, "🗄 Архивация запущена, итог придёт отдельным сообщением")
+    except Exception as e:
+        logger.error(f"Ошибка в run_archive: {e}")
+        bot.send_message(message.chat.id, "Произошла ошибка")
+
+# Профилирование по команде мастера: /profile [секунды]
+PROFILE_MAX_SECONDS = 600
+PROFILE_DIR = os.path.join(DATA_DIR, 'profiles')
+profiling_session = None
+
+class ProfilingSession:
+    """cProfile и tracemalloc на заданное время с разбивкой по обработчикам"""
+
+    def __init__(self, seconds, chat_id):
+        self.seconds = seconds
+        self.chat_id = chat_id
+        self.profiles = {}
+        self.handler_stats = {}
+        self.lock = threading.Lock()
+        self.start_snapshot = None
+
+    def start(self):
+        tracemalloc.start(10)
+        self.start_snapshot = tracemalloc.take_snapshot()
+        timer = threading.Timer(self.seconds, self.finish)
+        timer.daemon = True
+        timer.start()
+
+    def run(self, name, func, args, kwargs):
+        with self.lock:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            peak = max(0, tracemalloc.get_traced_memory()[1] - start_memory)
+            with self.lock:
+                stat = self.handler_stats.setdefault(name, [0, 0.0, 0])
+                stat[0] += 1
+                stat[1] += elapsed
+                stat[2] = max(stat[2], peak)
+
+    def finish(self):
+        global profiling_session
+        profiling_session = None
+        try:
+            end_snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            text, prof_path = self.build_report(end_snapshot)
+            for i in range(0, len(text), 4000):
+                bot.send_message(self.chat_id, text[i:i + 4000])
+            if prof_path:
+                with open(prof_path, 'rb') as f:
+                    bot.send_document(self.chat_id, f, caption='Профиль cProfile (pstats / snakeviz)')
+        except Exception as e:
+            logger.error(f"Ошибка формирования профиля: {e}", exc_info=True)
+
+    def build_report(self, end_snapshot):
+        text = f"📈 Профиль за {self.seconds} с\n"
+        if not self.handler_stats:
+            return text + "Обработчики не вызывались", None
+
+        text += "\n🧩 По обработчикам (вызовов / всего / среднее / пик памяти):\n"
+        for name, (calls, total, peak) in sorted(self.handler_stats.items(), key=lambda i: -i[1][1]):
+            text += f"{name}: {calls} / {total * 1000:.0f} мс / {total / calls * 1000:.1f} мс / {peak / 1024:.0f} КБ\n"
+
+        profiles = list(self.profiles.values())
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        text += "\n⏱ Топ функций (собственное время / с вложенными):\n"
+        top = sorted(stats.stats.items(), key=lambda i: -i[1][2])[:15]
+        for (filename, line, func), (cc, nc, tt, ct, callers) in top:
+            text += f"{tt * 1000:.1f} / {ct * 1000:.1f} мс  {func} ({os.path.basename(filename)}:{line}) ×{nc}\n"
+
+        text += "\n🧠 Топ мест выделения памяти:\n"
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        diff = end_snapshot.filter_traces(filters).compare_to(self.start_snapshot.filter_traces(filters), 'lineno')
+        for stat in diff[:10]:
+            frame = stat.traceback[0]
+            text += f"{stat.size_diff / 1024:+.0f} КБ ({stat.count_diff:+d})  {os.path.basename(frame.filename)}:{frame.lineno}\n"
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        prof_path = os.path.join(PROFILE_DIR, f"profile_{datetime.now().strftime('%Y%m%d%H%M%S')}.prof")
+        stats.dump_stats(prof_path)
+        return text, prof_path
+
+def profiled(func):
+    """Обёртка обработчика: пока профилирование выключено, это одна проверка"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        session = profiling_session
+        if session is None:
+            return func(*args, **kwargs)
+        return session.run(name, func, args, kwargs)
+    return wrapper
+
+@bot.message_handler(commands=['profile'])
+def start_profiling(message):
+    global profiling_session
+    if message.from_user.id != MASTER_ID:
+        return
+
+    try:
+        parts = message.text.split()
+        seconds = int(parts[1]) if len(parts) > 1 else 60
+        if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+            return bot.send_message(message.chat.id, f'Длительность: от 1 до {PROFILE_MAX_SECONDS} секунд')
+        if profiling_session is not None:
+            return bot.send_message(message.chat.id, 'Профилирование уже запущено')
+
+        session = ProfilingSession(seconds, message.chat.id)
+        session.start()
+        profiling_session = session
+        bot.send_message(message.chat.id, f"Профилирование запущено на {seconds} с")
+    except ValueError:
+        bot.send_message(message.chat.id, 'Используйте: /profile [секунды]')
+    except Exception as e:
+        logger.error(f"Ошибка в start_profiling: {e}")
+        bot.send_message(message.chat.id, "Произошла ошибка")
+
+# Статистика исходящих HTTP-соединений процесса, обслуживающего мастера
+@bot.message_handler(commands=['netstat'])
+def show_net_stats(message):
+    if message.from_user.id != MASTER_ID:
+        return
+    try:
+        bot.send_message(message.chat.id, http_stats_text())
+    except Exception as e:
+        logger.error(f"Ошибка в show_net_stats: {e}")
+        bot.send_message(message.chat.id, "Произошла ошибка")
+
 # Фоллбэк
 @bot.message_handler(func=lambda _: True)
 def fallback(message):
     bot.send_message(message.chat.id, 'Пожалуйста, выберите действие:', reply_markup=create_main_menu())
 
+for handlers in (bot.message_handlers, bot.callback_query_handlers):
+    for handler in handlers:
+        handler['function'] = profiled(handler['function'])
+
 # Создание директорий
-for d in ['photos','stickers', 'pdf_receipts']:
+for d in [*ARTIFACT_DIRS, DATA_DIR]:
     os.makedirs(d, exist_ok=True)
 
+# Масштабирование: несколько рабочих процессов, распределение по chat_id
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+
+class HashRing:
+    """Консистентное хеширование chat_id на номера рабочих процессов"""
+
+    def __init__(self, nodes, replicas=100):
+        self.ring = sorted(
+            (self.hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self.keys = [k for k, _ in self.ring]
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(str(key).encode()).hexdigest()[:16], 16)
+
+    def lookup(self, key):
+        idx = bisect.bisect(self.keys, self.hash(key)) % len(self.keys)
+        return self.ring[idx][1]
+
+def update_chat_id(raw):
+    """Достаёт chat_id из «сырого» обновления Telegram"""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in raw:
+            return raw[key]['chat']['id']
+    if 'callback_query' in raw:
+        cq = raw['callback_query']
+        if cq.get('message'):
+            return cq['message']['chat']['id']
+        return cq['from']['id']
+    for value in raw.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return 0
+
+# Сколько фронтовой процесс ждёт рабочий после SIGTERM, прежде чем убить его
+WORKER_KILL_TIMEOUT = 5
+
+def run_worker(index, updates_queue, snapshot):
+    """Рабочий процесс: обрабатывает обновления своих чатов строго по порядку"""
+    # Ctrl+C приходит всей группе процессов — останавливает только фронтовой процесс.
+    # SIGTERM от него означает «не успели»: доделываем текущее обновление,
+    # сохраняем снимок и выходим, остаток очереди фронтовой процесс заберёт сам
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda sig, frame: stop.set())
+    apply_snapshot(snapshot)
+    if snapshot.get('background'):
+        sla_scheduler.start()
+        archiver.start()
+    logger.info(f"Worker {index} started")
+    while not stop.is_set():
+        try:
+            raw = updates_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if raw is None:
+            break
+        try:
+            bot.process_new_updates([types.Update.de_json(raw)])
+        except Exception as e:
+            logger.error(f"Ошибка в рабочем процессе {index}: {e}", exc_info=True)
+    save_snapshot(f'worker-{index}')
+    logger.info(f"Worker {index} stopped")
+
+def stop_workers(queues, workers):
+    """Дожидается обработки очередей (не дольше SHUTDOWN_TIMEOUT), остаток сохраняет в снимок.
+
+    Не успевший рабочий получает SIGTERM и ещё WORKER_KILL_TIMEOUT секунд на
+    снимок, после чего убивается: остановка всегда укладывается в срок.
+    """
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for q in queues:
+        q.put(None)
+    for w in workers:
+        w.join(max(0, deadline - time.monotonic()))
+    late = [w for w in workers if w.is_alive()]
+    for w in late:
+        logger.warning(f"{w.name} did not finish in time, terminating")
+        w.terminate()
+    deadline = time.monotonic() + WORKER_KILL_TIMEOUT
+    for w in late:
+        w.join(max(0, deadline - time.monotonic()))
+        if w.is_alive():
+            logger.warning(f"{w.name} did not stop after SIGTERM, killing")
+            w.kill()
+            w.join()
+    pending = []
+    for q in queues:
+        try:
+            while True:
+                raw = q.get(timeout=0.1)
+                if raw is not None:
+                    pending.append(raw)
+        except queue.Empty:
+            pass
+    # Фронтовой процесс кэшей не строит — его пустые разделы не должны затирать кэши рабочих
+    save_snapshot('front', pending, with_sections=False)
+
+def run_front(workers_count):
+    """Фронтовой процесс: получает обновления и раздаёт их рабочим процессам"""
+    snapshot = load_snapshots()
+    y.ensure_dir('')
+    threading.Thread(target=artifacts.startup, args=(ARTIFACT_DIRS,), name='artifacts', daemon=True).start()
+    ring = HashRing(range(workers_count))
+    ctx = multiprocessing.get_context('spawn')
+    queues = [ctx.Queue() for _ in range(workers_count)]
+    workers = []
+    for i, q in enumerate(queues):
+        part = {
+            'chats': {c: v for c, v in snapshot['chats'].items() if ring.lookup(int(c)) == i},
+            'sections': snapshot['sections'],
+            'pending_updates': [],
+            # SLA-таймеры и архивацию ведёт один процесс — тот, что обслуживает мастера
+            'background': ring.lookup(MASTER_ID) == i
+        }
+        workers.append(ctx.Process(target=run_worker, args=(i, q, part), name=f'worker-{i}', daemon=True))
+    for w in workers:
+        w.start()
+    for raw in snapshot['pending_updates']:
+        queues[ring.lookup(update_chat_id(raw))].put(raw)
+
+    offset = None
+    while not shutdown_event.is_set():
+        try:
+            updates = apihelper.get_updates(BOT_TOKEN, offset, 100, 20, long_polling_timeout=10)
+        except Exception as e:
+            logger.error(f"Ошибка получения обновлений: {e}")
+            shutdown_event.wait(3)
+            continue
+        for raw in updates:
+            offset = raw['update_id'] + 1
+            queues[ring.lookup(update_chat_id(raw))].put(raw)
+    if offset:
+        confirm_updates(offset)
+    stop_workers(queues, workers)
+
+def run_single():
+    """Обычный режим: один процесс"""
+    apply_snapshot(load_snapshots())
+    y.ensure_dir('')
+    threading.Thread(target=artifacts.startup, args=(ARTIFACT_DIRS,), name='artifacts', daemon=True).start()
+    sla_scheduler.start()
+    archiver.start()
+    bot.infinity_polling(long_polling_timeout=10)
+    if bot.last_update_id:
+        confirm_updates(bot.last_update_id + 1)
+    save_snapshot('main')
+
 # Запуск
 if __name__ == '__main__':
     logger.info('Bot starting...')
     try:
-        bot.infinity_polling()
+        if BOT_WORKERS > 1:
+            run_front(BOT_WORKERS)
+        else:
+            run_single()
+        logger.info("Bot shutdown gracefully")
     except Exception as e:
         logger.error(f"Bot stopped with error: {e}")
         sys.exit(1)
\ No newline at end of file
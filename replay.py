@@ -0,0 +1,493 @@
+"""Воспроизведение записанного трафика (TRAFFIC_RECORD_PATH) для нагрузочных тестов.
+
+Обновления подаются в обработчики bot.py с заданным ускорением, а Telegram,
+Google Sheets и Яндекс.Диск заменяются локальными заглушками в памяти.
+
+Пример:
+    python replay.py traffic.jsonl --speed 10 --latency-ms 50
+"""
+import os
+import sys
+import re
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import hashlib
+import socketserver
+from collections import defaultdict
+
+import requests
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_MASTER_ID = 1  # так TrafficRecorder обозначает мастера
+FAKE_JPEG = b'\xff\xd8\xff\xe0' + b'\x00' * 1024 + b'\xff\xd9'
+fake_latency = 0.0
+
+
+def simulate_latency():
+    if fake_latency:
+        time.sleep(fake_latency)
+
+
+# Заглушка Google Sheets
+class FakeCell:
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+class FakeWorksheet:
+    HEADER = ['ID', 'Дата', 'Имя', 'Телефон', 'Устройство', 'Модель', 'Неисправность',
+              'Комментарий', 'Фото', 'Статус', 'Стоимость', '', '']
+
+    def __init__(self, title='Лист1'):
+        self.title = title
+        self.id = 0
+        self.rows = [list(self.HEADER)]
+        self.lock = threading.Lock()
+
+    def get_all_values(self):
+        simulate_latency()
+        with self.lock:
+            return [list(r) for r in self.rows]
+
+    def get_all_records(self):
+        simulate_latency()
+        with self.lock:
+            header = self.rows[0]
+            return [
+                {h: (v if v != '' else '') for h, v in zip(header, r) if h}
+                for r in self.rows[1:]
+            ]
+
+    def append_row(self, row, **kwargs):
+        simulate_latency()
+        with self.lock:
+            self.rows.append([str(v) for v in row])
+
+    def append_rows(self, rows, **kwargs):
+        simulate_latency()
+        with self.lock:
+            first = len(self.rows) + 1
+            self.rows.extend([str(v) for v in row] for row in rows)
+            last = len(self.rows)
+        return {'updates': {'updatedRange': f"'{self.title}'!A{first}:M{last}", 'updatedRows': len(rows)}}
+
+    def get(self, a1):
+        """Поддерживается только хвост листа вида 'A10:M'"""
+        simulate_latency()
+        start = int(re.match(r'A(\d+):', a1).group(1))
+        with self.lock:
+            return [list(r) for r in self.rows[start - 1:]]
+
+    def col_values(self, col):
+        simulate_latency()
+        with self.lock:
+            values = [r[col - 1] if col <= len(r) else '' for r in self.rows]
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+    def delete_rows(self, start, end=None):
+        simulate_latency()
+        with self.lock:
+            del self.rows[start - 1:(end or start)]
+
+    def find(self, query, in_column=None, **kwargs):
+        simulate_latency()
+        with self.lock:
+            for i, r in enumerate(self.rows, start=1):
+                for j, v in enumerate(r, start=1):
+                    if in_column and j != in_column:
+                        continue
+                    if v == query:
+                        return FakeCell(i, j, v)
+        import gspread
+        raise gspread.exceptions.CellNotFound(query)
+
+    def row_values(self, row):
+        simulate_latency()
+        with self.lock:
+            return list(self.rows[row - 1])
+
+    def cell(self, row, col):
+        simulate_latency()
+        with self.lock:
+            r = self.rows[row - 1]
+            return FakeCell(row, col, r[col - 1] if col <= len(r) else '')
+
+    def update_cell(self, row, col, value):
+        simulate_latency()
+        with self.lock:
+            r = self.rows[row - 1]
+            r.extend([''] * (col - len(r)))
+            r[col - 1] = str(value)
+
+    def batch_get(self, ranges, **kwargs):
+        """Поддерживаются только целые колонки вида 'A:A'"""
+        import gspread
+        simulate_latency()
+        result = []
+        with self.lock:
+            for a1 in ranges:
+                _, col = gspread.utils.a1_to_rowcol(a1.split(':')[0] + '1')
+                values = [[r[col - 1]] if col <= len(r) and r[col - 1] != '' else [] for r in self.rows]
+                while values and not values[-1]:
+                    values.pop()
+                result.append(values)
+        return result
+
+    def batch_update(self, data, **kwargs):
+        import gspread
+        simulate_latency()
+        with self.lock:
+            for item in data:
+                row, col = gspread.utils.a1_to_rowcol(item['range'])
+                r = self.rows[row - 1]
+                r.extend([''] * (col - len(r)))
+                r[col - 1] = str(item['values'][0][0])
+
+    def seed(self, count):
+        for aid in range(1, count + 1):
+            self.rows.append([str(aid), '2024-01-01 10:00:00', 'Клиент', '+70000000000',
+                              'Телефон', 'Модель', 'Не включается', '-', '', 'Новая', '', '', ''])
+
+
+class FakeSpreadsheet:
+    url = 'https://docs.google.com/spreadsheets/d/replay'
+
+    def __init__(self):
+        self.sheet1 = FakeWorksheet()
+        self.extra = {}
+
+    def batch_update(self, body):
+        """Поддерживается только deleteDimension для первого листа"""
+        simulate_latency()
+        with self.sheet1.lock:
+            for request in body['requests']:
+                span = request['deleteDimension']['range']
+                del self.sheet1.rows[span['startIndex']:span['endIndex']]
+        return {}
+
+    def worksheet(self, title):
+        import gspread
+        simulate_latency()
+        if title not in self.extra:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.extra[title]
+
+    def add_worksheet(self, title, rows, cols, **kwargs):
+        simulate_latency()
+        ws = FakeWorksheet(title)
+        ws.rows = []
+        self.extra[title] = ws
+        return ws
+
+
+class FakeGspreadClient:
+    def __init__(self):
+        self.spreadsheet = FakeSpreadsheet()
+        self.session = requests.Session()
+        self.timeout = None
+
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+
+    def open(self, name):
+        return self.spreadsheet
+
+
+# Заглушка Telegram Bot API
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, result):
+        self.payload = {'ok': True, 'result': result}
+        self.text = json.dumps(self.payload)
+
+    def json(self):
+        return self.payload
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.message_id = 0
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def __call__(self, method, url, params=None, files=None, **kwargs):
+        simulate_latency()
+        api_method = url.rsplit('/', 1)[-1]
+        params = params or {}
+        with self.lock:
+            self.calls[api_method] += 1
+            self.message_id += 1
+            message_id = self.message_id
+        if api_method == 'getMe':
+            result = {'id': 999, 'is_bot': True, 'first_name': 'Replay', 'username': 'replay_bot'}
+        elif api_method == 'getFile':
+            result = {'file_id': params.get('file_id'), 'file_unique_id': 'u', 'file_path': 'photos/file.jpg'}
+        elif api_method.startswith('send'):
+            chat_id = int(params.get('chat_id', 0))
+            result = {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', '')
+            }
+        elif api_method == 'getUpdates':
+            result = []
+        else:
+            result = True
+        return FakeResponse(result)
+
+
+# Заглушка Яндекс.Диска
+class FakeDiskMeta:
+    def __init__(self, data):
+        self.size = len(data)
+        self.md5 = hashlib.md5(data).hexdigest()
+
+
+def install_fake_disk(yadisk):
+    files = {}
+    dirs = set()
+    lock = threading.Lock()
+
+    def mkdir(self, path, **kwargs):
+        simulate_latency()
+        with lock:
+            if path in dirs:
+                raise yadisk.exceptions.DirectoryExistsError(None, 'exists')
+            dirs.add(path)
+
+    def get_meta(self, path, **kwargs):
+        simulate_latency()
+        with lock:
+            if path not in files:
+                raise yadisk.exceptions.PathNotFoundError(None, 'not found')
+            return FakeDiskMeta(files[path])
+
+    def upload(self, src, dst, **kwargs):
+        simulate_latency()
+        with open(src, 'rb') as f:
+            data = f.read()
+        with lock:
+            files[dst] = data
+
+    def download(self, src, dst, **kwargs):
+        simulate_latency()
+        with lock:
+            data = files[src]
+        with open(dst, 'wb') as f:
+            f.write(data)
+
+    yadisk.YaDisk.mkdir = mkdir
+    yadisk.YaDisk.get_meta = get_meta
+    yadisk.YaDisk.upload = upload
+    yadisk.YaDisk.download = download
+
+
+# Заглушка термопринтера: принимает RAW-задания по TCP и сохраняет байты
+class FakePrinter:
+    def __init__(self, workdir):
+        self.jobs = []
+        self.dir = os.path.join(workdir, 'printed')
+        os.makedirs(self.dir, exist_ok=True)
+        printer = self
+
+        class JobHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                data = self.rfile.read()
+                with open(os.path.join(printer.dir, f"job-{len(printer.jobs) + 1}.bin"), 'wb') as f:
+                    f.write(data)
+                printer.jobs.append(len(data))
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), JobHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"tcp://127.0.0.1:{self.server.server_address[1]}"
+
+
+def load_bot(workdir, printer=None, label_format='pdf'):
+    """Импортирует bot.py с подменёнными внешними сервисами"""
+    os.environ.update({
+        'BOT_TOKEN': '0:replay',
+        'MASTER_ID': str(FAKE_MASTER_ID),
+        'MASTER_PHONE': '+70000000000',
+        'SPREADSHEET_NAME': 'replay',
+        'YANDEX_DISK_TOKEN': 'replay',
+        'YANDEX_DISK_FOLDER': 'replay',
+    })
+    os.environ.pop('TRAFFIC_RECORD_PATH', None)
+    os.environ.pop('YADISK_API_URL', None)
+    os.environ['LABEL_FORMAT'] = label_format
+    os.environ['LABEL_PRINTER'] = printer.url if printer else ''
+    # Рабочий каталог как в контейнере: шрифты рядом, данные отдельно
+    for font in ('Arial.ttf', 'DejaVuSans.ttf'):
+        if not os.path.exists(os.path.join(workdir, font)):
+            os.symlink(os.path.join(BOT_DIR, font), os.path.join(workdir, font))
+    os.chdir(workdir)
+    sys.path.insert(0, BOT_DIR)
+
+    import gspread
+    import yadisk
+    from oauth2client.service_account import ServiceAccountCredentials
+    from telebot import apihelper
+
+    gspread.authorize = lambda creds: FakeGspreadClient()
+    ServiceAccountCredentials.from_json_keyfile_name = classmethod(lambda cls, *a, **k: None)
+    install_fake_disk(yadisk)
+    fake_telegram = FakeTelegram()
+    apihelper.CUSTOM_REQUEST_SENDER = fake_telegram
+
+    # load_dotenv() не перезаписывает уже заданные переменные
+    import bot
+    bot.bot.download_file = lambda file_path: FAKE_JPEG
+    return bot, fake_telegram
+
+
+class HandlerStats:
+    """Время работы и ошибки по каждому обработчику"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.current = threading.local()
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            self.current.name = name
+            self.current.failed = False
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                self.current.failed = True
+                raise
+            finally:
+                self.latencies[name].append(time.perf_counter() - started)
+                if self.current.failed:
+                    self.errors[name] += 1
+                self.current.name = None
+        return timed
+
+    def instrument(self, telebot_instance):
+        for handlers in (telebot_instance.message_handlers, telebot_instance.callback_query_handlers):
+            for handler in handlers:
+                func = handler['function']
+                handler['function'] = self.wrap(func.__name__, func)
+
+    def on_error_logged(self):
+        # Обработчики бота ловят исключения сами и пишут их в лог
+        if getattr(self.current, 'name', None):
+            self.current.failed = True
+
+
+class ErrorLogHandler(logging.Handler):
+    def __init__(self, stats):
+        super().__init__(level=logging.ERROR)
+        self.stats = stats
+
+    def emit(self, record):
+        self.stats.on_error_logged()
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def read_traffic(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def max_referenced_id(records):
+    """Наибольший номер заявки, на который ссылаются записанные действия мастера"""
+    pattern = re.compile(r'(?:accept_|reject_|/setstatus |/money )(\d+)')
+    found = [0]
+    for rec in records:
+        upd = rec['update']
+        text = upd.get('message', {}).get('text') or upd.get('callback_query', {}).get('data') or ''
+        found.extend(int(m) for m in pattern.findall(text))
+    return max(found)
+
+
+def replay(bot_module, records, speed, stats):
+    from telebot import types
+
+    started = time.perf_counter()
+    ts0 = records[0]['ts'] if records else 0
+    max_lag = 0.0
+    for rec in records:
+        due = started + (rec['ts'] - ts0) / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            max_lag = max(max_lag, -delay)
+        try:
+            bot_module.bot.process_new_updates([types.Update.de_json(rec['update'])])
+        except Exception as e:
+            logging.getLogger('replay').error(f"Update {rec['update']['update_id']}: {e}")
+    return time.perf_counter() - started, max_lag
+
+
+def print_report(stats, total, elapsed, max_lag, fake_telegram):
+    print(f"\nОбновлений: {total}, время: {elapsed:.2f} с, "
+          f"пропускная способность: {total / elapsed if elapsed else 0:.1f} обн/с, "
+          f"макс. отставание от графика: {max_lag * 1000:.0f} мс")
+    print(f"{'обработчик':<28}{'вызовов':>8}{'p50 мс':>9}{'p90 мс':>9}{'p99 мс':>9}{'max мс':>9}{'ошибки':>9}")
+    for name in sorted(stats.latencies):
+        values = stats.latencies[name]
+        errors = stats.errors[name]
+        print(f"{name:<28}{len(values):>8}"
+              f"{percentile(values, 50) * 1000:>9.1f}{percentile(values, 90) * 1000:>9.1f}"
+              f"{percentile(values, 99) * 1000:>9.1f}{max(values) * 1000:>9.1f}"
+              f"{errors / len(values) * 100:>8.1f}%")
+    print("Вызовы Telegram API: " + ', '.join(f"{k}={v}" for k, v in sorted(fake_telegram.calls.items())))
+
+
+def main():
+    global fake_latency
+    parser = argparse.ArgumentParser(description='Воспроизведение записанного трафика бота')
+    parser.add_argument('traffic', help='JSONL-файл, записанный через TRAFFIC_RECORD_PATH')
+    parser.add_argument('--speed', type=float, default=1.0, help='ускорение (1, 10, 100)')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='задержка каждой заглушки, мс')
+    parser.add_argument('--labels', choices=['pdf', 'zpl', 'escpos'], default='pdf',
+                        help='формат стикеров; zpl и escpos печатаются на заглушку принтера')
+    args = parser.parse_args()
+
+    records = read_traffic(os.path.abspath(args.traffic))
+    fake_latency = args.latency_ms / 1000
+    workdir = tempfile.mkdtemp(prefix='robofix-replay-')
+    printer = FakePrinter(workdir) if args.labels != 'pdf' else None
+    bot_module, fake_telegram = load_bot(workdir, printer, args.labels)
+    bot_module.sheet.seed(max_referenced_id(records))
+
+    stats = HandlerStats()
+    stats.instrument(bot_module.bot)
+    bot_module.logger.addHandler(ErrorLogHandler(stats))
+    # Заглушки не требуют подробного лога — оставляем в консоли только ошибки
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler):
+            handler.setLevel(logging.ERROR)
+
+    elapsed, max_lag = replay(bot_module, records, args.speed, stats)
+    print_report(stats, len(records), elapsed, max_lag, fake_telegram)
+    if printer:
+        print(f"Заданий печати: {len(printer.jobs)}, байт: {sum(printer.jobs)}")
+    print(f"Рабочий каталог: {workdir}")
+
+
+if __name__ == '__main__':
+    main()